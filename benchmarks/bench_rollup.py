@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Offline rollup benchmark: synthetic GBFS data + a local-disk bucket.
+
+Runs gcp-functions/rollup end to end against a directory standing in for GCS
+(see local_storage.py) in two timed stages:
+
+  full         fresh instance (no state DB, no daily aggregates) rebuilding the whole window
+  incremental  the next run after `--new-ticks` more snapshots land, reusing the
+               state DB like a warm instance (or a fresh one with --cold)
+
+Each stage runs in its own process so peak RSS is that stage's alone. The
+report gives wall time, peak RSS and snapshots/sec plus the per-stage spans
+from the rollup's run record, and the exit status is 1
+if a stage goes over the Cloud Function's timeout or memory limit.
+
+Usage: python3 benchmarks/bench_rollup.py --stations 600 --days 30 [--json results.json]
+"""
+
+import argparse
+import contextlib
+import datetime as dt
+import importlib.util
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic_gbfs
+from local_storage import LocalClient, local_filesystem
+
+ROLLUP_MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gcp-functions", "rollup", "main.py")
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_stage(root, bucket_name, state_db, mode, log_path, results):
+    """Child process body: import the rollup against the local bucket and time one run."""
+    os.environ["BUCKET_NAME"] = bucket_name
+    os.environ["STATE_DB"] = state_db
+    spec = importlib.util.spec_from_file_location("rollup_main", ROLLUP_MAIN)
+    rollup = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(rollup)
+
+    fs = local_filesystem(root)
+    bucket = LocalClient(root).bucket(bucket_name)
+    with open(log_path, "a") as log, contextlib.redirect_stdout(log):
+        print(f"=== {mode} ===")
+        started = time.perf_counter()
+        con = rollup.open_state_db(state_db)
+        try:
+            body, status = rollup.run_rollup(fs, bucket, con, mode=mode)
+        finally:
+            con.close()
+        wall = time.perf_counter() - started
+    # The rollup's own run record (last line of the run history) has the per-stage spans
+    run_record = json.loads(bucket.blob(rollup.RUN_HISTORY_BLOB).download_as_text().splitlines()[-1])
+    results.put({"wall_s": wall, "peak_rss_mb": peak_rss_mb(), "status": status, "body": body,
+                 "spans": run_record["spans"]})
+
+
+def timed_stage(root, bucket_name, state_db, mode, log_path):
+    """Run one stage in a fresh (spawned) process and return its measurements."""
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    proc = ctx.Process(target=run_stage, args=(root, bucket_name, state_db, mode, log_path, results))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        raise RuntimeError(f"{mode} stage failed (exit {proc.exitcode}); see {log_path}")
+    return results.get()
+
+
+def count_snapshots(root, bucket_name, after=None):
+    """Snapshot files in the local bucket, optionally only those later than `after` (Central time)."""
+    base = os.path.join(root, bucket_name, "snapshots")
+    count = 0
+    for folder, _, files in os.walk(base):
+        day = os.path.relpath(folder, base).replace(os.sep, "/")
+        for name in files:
+            if not name.endswith(".json.gz"):
+                continue
+            if after is None or f"{day}/{name}" > f"{after:%Y/%m/%d}/{after:%H%M%S}.json.gz":
+                count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the rollup on synthetic data")
+    parser.add_argument("--root", help="directory standing in for GCS (default: a temp dir)")
+    parser.add_argument("--bucket", default="divvy-bench")
+    parser.add_argument("--stations", type=int, default=600)
+    parser.add_argument("--days", type=int, default=30, help="full days of snapshots before today")
+    parser.add_argument("--ticks", type=int, default=96, help="snapshots per day")
+    parser.add_argument("--new-ticks", type=int, default=4, help="snapshots added before the incremental run")
+    parser.add_argument("--churn", type=float, default=0.3, help="fraction of stations changing per tick")
+    parser.add_argument("--full-snapshots", action="store_true", help="legacy full snapshots instead of deltas")
+    parser.add_argument("--csv-capacity", action="store_true", help="only station_capacity.csv, no station_dim.parquet")
+    parser.add_argument("--cold", action="store_true", help="drop the state DB before the incremental run")
+    parser.add_argument("--timeout", type=float, default=300, help="function timeout to check against (s, as in deploy.sh)")
+    parser.add_argument("--memory-mb", type=float, default=1024, help="function memory limit to check against (MiB, as in deploy.sh)")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the generated data")
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix="divvy-bench-")
+    shutil.rmtree(os.path.join(root, args.bucket), ignore_errors=True)
+    state_db = os.path.join(root, "rollup_state.duckdb")
+    log_path = os.path.join(root, "rollup.log")
+    for path in (state_db, log_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    # The incremental run picks up ticks after the full run's watermark, so the
+    # full run sees everything up to `cutoff` and the last --new-ticks arrive after it.
+    # New ticks are kept within today so the finished days stay compacted.
+    central_tz = synthetic_gbfs.CENTRAL_TZ
+    now = dt.datetime.now(central_tz)
+    step = dt.timedelta(days=1) / args.ticks
+    last_tick = synthetic_gbfs.tick_times(0, args.ticks, now)[-1]
+    cutoff = max(last_tick - step * args.new_ticks,
+                 central_tz.localize(dt.datetime.combine(now.date(), dt.time())) - step / 2)
+
+    print(f"Generating {args.stations} stations × {args.days} days × {args.ticks} ticks under {root}...")
+    started = time.perf_counter()
+    synthetic_gbfs.write_static_files(root, args.bucket, args.stations, station_dim=not args.csv_capacity)
+    synthetic_gbfs.write_snapshots(root, args.bucket, args.stations, args.days, args.ticks, cutoff,
+                                   churn=args.churn, full_snapshots=args.full_snapshots)
+    print(f"✓ generated in {time.perf_counter() - started:.1f}s")
+
+    results = {
+        "stations": args.stations, "days": args.days, "ticks": args.ticks,
+        "snapshot_format": "full" if args.full_snapshots else "keyframe+delta",
+        "stages": {},
+    }
+
+    full_snapshots = count_snapshots(root, args.bucket)
+    stage = timed_stage(root, args.bucket, state_db, "full", log_path)
+    results["stages"]["full"] = {**stage, "snapshots": full_snapshots}
+
+    # Pin the watermark to the data the full run saw, then land the new ticks
+    with open(os.path.join(root, args.bucket, "aggregated", "rollup_state.txt"), "w") as f:
+        f.write(cutoff.isoformat())
+    synthetic_gbfs.write_snapshots(root, args.bucket, args.stations, args.days, args.ticks, now,
+                                   churn=args.churn, full_snapshots=args.full_snapshots)
+    if args.cold and os.path.exists(state_db):
+        os.remove(state_db)
+    new_snapshots = count_snapshots(root, args.bucket, after=cutoff)
+    stage = timed_stage(root, args.bucket, state_db, "incremental", log_path)
+    results["stages"]["incremental"] = {**stage, "snapshots": new_snapshots}
+
+    over_budget = False
+    print(f"\n{'stage':<12} {'snapshots':>9} {'wall_s':>8} {'peak_rss_mb':>11} {'snapshots/s':>11}  result")
+    for name, stage in results["stages"].items():
+        stage["snapshots_per_s"] = stage["snapshots"] / stage["wall_s"] if stage["wall_s"] else None
+        flags = []
+        if stage["wall_s"] > args.timeout:
+            flags.append(f"OVER {args.timeout:.0f}s TIMEOUT")
+        if stage["peak_rss_mb"] > args.memory_mb:
+            flags.append(f"OVER {args.memory_mb:.0f}MB MEMORY")
+        if stage["status"] != 200:
+            flags.append(f"HTTP {stage['status']}")
+        over_budget = over_budget or bool(flags)
+        print(f"{name:<12} {stage['snapshots']:>9} {stage['wall_s']:>8.2f} {stage['peak_rss_mb']:>11.1f} "
+              f"{stage['snapshots_per_s'] or 0:>11.1f}  {', '.join(flags) or stage['body']}")
+
+    for name, stage in results["stages"].items():
+        print(f"\n{name} stages:")
+        for span in stage["spans"]:
+            print(f"  {span['stage']:<28} {span['duration_s']:>8.3f}s {span['objects']:>6} objs "
+                  f"{span['bytes_read'] / 1e6:>8.2f} MB {span['rows']:>9} rows {span['peak_rss_mb']:>7.1f} MB peak")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"✓ results written to {args.json}")
+    if args.keep or args.root:
+        print(f"Rollup output: {log_path}")
+    else:
+        shutil.rmtree(root, ignore_errors=True)
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
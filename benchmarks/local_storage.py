@@ -0,0 +1,94 @@
+"""
+Local-filesystem stand-ins for the GCS calls the Cloud Functions make.
+
+A directory on disk plays the role of GCS: `<root>/<bucket>/<blob name>`.
+`local_filesystem(root)` replaces gcsfs.GCSFileSystem (paths stay
+"bucket/blob"), and LocalClient/LocalBucket/LocalBlob cover the subset of
+google.cloud.storage the functions use. Each file's mtime stands in for its
+generation, and `if_generation_match` (0 = must not exist) is honoured. Only
+the live generation is kept, so reading an older one raises NotFound.
+"""
+
+import os
+import shutil
+
+import fsspec
+from fsspec.implementations.dirfs import DirFileSystem
+from google.api_core import exceptions as gcs_exceptions
+
+
+def local_filesystem(root):
+    """fsspec filesystem rooted at `root`, addressed like gcsfs ("bucket/path")."""
+    os.makedirs(root, exist_ok=True)
+    return DirFileSystem(path=root, fs=fsspec.filesystem("file"))
+
+
+class LocalBlob:
+    def __init__(self, bucket, name, generation=None):
+        self.bucket = bucket
+        self.name = name
+        self.pinned_generation = generation
+        self.path = os.path.join(bucket.root, bucket.name, name)
+
+    @property
+    def generation(self):
+        return os.stat(self.path).st_mtime_ns
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def reload(self):
+        pass
+
+    def download_as_bytes(self):
+        if self.pinned_generation is not None and (not self.exists() or self.generation != self.pinned_generation):
+            raise gcs_exceptions.NotFound(f"{self.name}#{self.pinned_generation}")
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def download_as_text(self):
+        return self.download_as_bytes().decode()
+
+    def _check_generation(self, if_generation_match):
+        if if_generation_match is None:
+            return
+        current = self.generation if self.exists() else 0
+        if current != if_generation_match:
+            raise gcs_exceptions.PreconditionFailed(f"{self.name}: generation {current} != {if_generation_match}")
+
+    def _write(self, data):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        self._check_generation(if_generation_match)
+        self._write(data.encode() if isinstance(data, str) else data)
+
+    def upload_from_file(self, file_obj, content_type=None):
+        self._write(file_obj.read())
+
+    def upload_from_filename(self, filename, content_type=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+
+
+class LocalBucket:
+    def __init__(self, root, name):
+        self.root = root
+        self.name = name
+
+    def blob(self, name, generation=None):
+        return LocalBlob(self, name, generation)
+
+    def get_blob(self, name):
+        blob = LocalBlob(self, name)
+        return blob if blob.exists() else None
+
+
+class LocalClient:
+    def __init__(self, root):
+        self.root = root
+
+    def bucket(self, name):
+        return LocalBucket(self.root, name)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Synthetic GBFS data for benchmarking the rollup without a real bucket.
+
+Writes, under <root>/<bucket>/:
+  snapshots/YYYY/MM/DD/HHMMSS.json.gz   keyframe + delta snapshots, as the scraper writes them
+  aggregated/station_flows.parquet      all-time starts/ends per legacy station id
+  station_capacity.csv                  station_id ↔ legacy_id, name, lat/lon, capacity
+  aggregated/station_dim.parquet        the same stations as a one-version station dimension
+
+Station states follow a seeded random walk, so the same arguments always
+produce the same data and a later call with a larger `until` only adds the
+newer snapshot files.
+
+Usage: python3 benchmarks/synthetic_gbfs.py --root /tmp/divvy-bench --stations 600 --days 30
+"""
+
+import argparse
+import csv
+import datetime as dt
+import gzip
+import json
+import os
+import random
+
+import duckdb
+import pytz
+
+CENTRAL_TZ = pytz.timezone('America/Chicago')
+KEYFRAME_HOURS = 6  # Same default as the scraper
+
+
+def station_ids(i):
+    """(GBFS station_id, legacy short-name id) for the i-th synthetic station."""
+    return f"{0xa3b0 + i:x}-synthetic-{i:05d}", str(13000 + i)
+
+
+def station_capacity(i):
+    return 11 + (i * 7) % 20
+
+
+def write_static_files(root, bucket_name, stations, seed=1, station_dim=True):
+    """Write station_capacity.csv, aggregated/station_flows.parquet and (optionally) station_dim.parquet."""
+    rnd = random.Random(seed)
+    base = os.path.join(root, bucket_name)
+    os.makedirs(os.path.join(base, "aggregated"), exist_ok=True)
+
+    with open(os.path.join(base, "station_capacity.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["station_id", "legacy_id", "name", "lat", "lon", "capacity"])
+        writer.writeheader()
+        for i in range(stations):
+            station_id, legacy_id = station_ids(i)
+            writer.writerow({
+                "station_id": station_id,
+                "legacy_id": legacy_id,
+                "name": f"Synthetic St & {i} Ave",
+                "lat": round(41.75 + rnd.random() * 0.25, 6),
+                "lon": round(-87.75 + rnd.random() * 0.2, 6),
+                "capacity": station_capacity(i),
+            })
+
+    starts = [rnd.randint(500, 20000) for _ in range(stations)]
+    flows = [(station_ids(i)[1], starts[i], starts[i] + rnd.randint(-400, 400)) for i in range(stations)]
+    con = duckdb.connect()
+    con.execute("CREATE TABLE station_flows (station_id VARCHAR, starts BIGINT, ends BIGINT)")
+    con.executemany("INSERT INTO station_flows VALUES (?, ?, ?)", flows)
+    con.execute(f"COPY station_flows TO '{os.path.join(base, 'aggregated', 'station_flows.parquet')}' (FORMAT PARQUET)")
+    if station_dim:
+        # Same layout the stations sync function writes; every station on its first version
+        con.execute(f"""
+            COPY (
+                SELECT station_id::VARCHAR AS station_id, legacy_id::VARCHAR AS legacy_id, name::VARCHAR AS name,
+                       lat::DOUBLE AS lat, lon::DOUBLE AS lon, capacity::INTEGER AS capacity,
+                       TIMESTAMPTZ '2024-01-01 00:00:00+00' AS effective_from, NULL::TIMESTAMPTZ AS effective_to
+                FROM read_csv('{os.path.join(base, 'station_capacity.csv')}', all_varchar = true)
+            ) TO '{os.path.join(base, 'aggregated', 'station_dim.parquet')}' (FORMAT PARQUET)
+        """)
+    con.close()
+
+
+def tick_times(days, ticks, until):
+    """Central-time tick timestamps from midnight `days` days before `until` up to `until`."""
+    step = dt.timedelta(days=1) / ticks
+    times = []
+    day = until.date() - dt.timedelta(days=days)
+    while day <= until.date():
+        # Localize wall-clock times so each day keeps `ticks` snapshots across DST changes
+        midnight = dt.datetime.combine(day, dt.time())
+        times.extend(t for t in (CENTRAL_TZ.localize(midnight + step * n) for n in range(ticks)) if t <= until)
+        day += dt.timedelta(days=1)
+    return times
+
+
+def write_snapshots(root, bucket_name, stations, days, ticks, until, churn=0.3, full_snapshots=False, seed=1):
+    """Write the snapshot tree up to `until`; returns (snapshots written, snapshots already present).
+
+    Every tick `churn` of the stations gain or lose a bike. Busy stations drift
+    towards full so % time full is not uniformly zero. Snapshots are keyframes on
+    each day's first tick and every KEYFRAME_HOURS, deltas otherwise (or always
+    full, legacy-style, with `full_snapshots`).
+    """
+    rnd = random.Random(seed)
+    capacity = [station_capacity(i) for i in range(stations)]
+    bikes = [rnd.randint(0, c) for c in capacity]
+    pull = [rnd.choice([0.35, 0.5, 0.5, 0.65]) for _ in range(stations)]  # P(a bike arrives)
+    last_reported = None
+    previous, keyframe_at = None, None
+    written = skipped = 0
+
+    for ts_central in tick_times(days, ticks, until):
+        epoch = int(ts_central.timestamp())
+        if last_reported is None:
+            last_reported = [epoch] * stations
+        for i in rnd.sample(range(stations), int(stations * churn)):
+            bikes[i] = min(capacity[i], max(0, bikes[i] + (1 if rnd.random() < pull[i] else -1)))
+            last_reported[i] = epoch
+
+        records = {}
+        for i in range(stations):
+            station_id = station_ids(i)[0]
+            records[station_id] = {
+                "station_id": station_id,
+                "num_docks_available": capacity[i] - bikes[i],
+                "num_bikes_available": bikes[i],
+                "is_returning": 1,
+                "last_reported": last_reported[i],
+            }
+
+        keyframe = (
+            full_snapshots
+            or previous is None
+            or keyframe_at.date() != ts_central.date()
+            or ts_central - keyframe_at >= dt.timedelta(hours=KEYFRAME_HOURS)
+        )
+        if keyframe:
+            changed = list(records.values())
+            keyframe_at = ts_central
+        else:
+            changed = [r for sid, r in records.items() if previous[sid] != r]
+        previous = records
+
+        path = os.path.join(root, bucket_name, f"snapshots/{ts_central:%Y/%m/%d}/{ts_central:%H%M%S}.json.gz")
+        if os.path.exists(path):
+            skipped += 1
+            continue
+        doc = {"timestamp": ts_central.astimezone(dt.timezone.utc).isoformat(), "stations": changed}
+        if not full_snapshots:
+            doc["keyframe"] = keyframe
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(gzip.compress(json.dumps(doc).encode()))
+        written += 1
+
+    return written, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic divvy-live bucket on local disk")
+    parser.add_argument("--root", required=True, help="directory standing in for GCS")
+    parser.add_argument("--bucket", default="divvy-bench")
+    parser.add_argument("--stations", type=int, default=600)
+    parser.add_argument("--days", type=int, default=30, help="full days before today")
+    parser.add_argument("--ticks", type=int, default=96, help="snapshots per day")
+    parser.add_argument("--churn", type=float, default=0.3, help="fraction of stations changing per tick")
+    parser.add_argument("--full-snapshots", action="store_true", help="write legacy full snapshots, no deltas")
+    args = parser.parse_args()
+
+    until = dt.datetime.now(CENTRAL_TZ)
+    write_static_files(args.root, args.bucket, args.stations)
+    written, skipped = write_snapshots(args.root, args.bucket, args.stations, args.days, args.ticks, until,
+                                       churn=args.churn, full_snapshots=args.full_snapshots)
+    print(f"✓ {written} snapshots written ({skipped} already present) under {os.path.join(args.root, args.bucket)}")
+
+
+if __name__ == "__main__":
+    main()
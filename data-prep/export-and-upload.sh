@@ -10,21 +10,25 @@
 #   the Divvy Live dashboard project.
 #
 # What it does:
-#   1. Exports 'station_flows' table from data-prep/flows.duckdb to station_flows.parquet
-#   2. Uploads the Parquet file to gs://YOUR_BUCKET_NAME/aggregated/
-#   3. Optionally cleans up local files
+#   1. Exports 'station_flows' and 'station_hourly_demand' tables from data-prep/flows.duckdb
+#      to station_flows.parquet and station_hourly_demand.parquet
+#   2. Exports per-month station flows to station_flows_monthly/month=YYYY-MM/ partitions
+#      (read by the rollup when FLOWS_WINDOW_MONTHS is set)
+#   3. Uploads the Parquet files to gs://YOUR_BUCKET_NAME/aggregated/
+#   4. Optionally cleans up local files
 #
 # Prerequisites:
 #   - DuckDB CLI installed and accessible in PATH
 #   - Google Cloud SDK (gsutil) installed and authenticated 
-#   - data-prep/flows.duckdb file exists with 'station_flows' table
+#   - data-prep/flows.duckdb file exists with 'station_flows_hourly', 'station_flows' and
+#     'station_hourly_demand' tables
 #     (created by running: python3 data-prep/process_trips.py)
 #
 # Usage:
 #   bash data-prep/export-and-upload.sh
 #
 # Input: data-prep/flows.duckdb (DuckDB database with station_flows table)
-# Output: Uploads station_flows.parquet to Google Cloud Storage bucket
+# Output: Uploads station_flows.parquet and station_hourly_demand.parquet to Google Cloud Storage bucket
 #
 # Part of: Divvy Live Dashboard - Step 3c (Export & upload to Google Cloud)
 # ==============================================================================
@@ -36,10 +40,15 @@ BUCKET_NAME="YOUR_BUCKET_NAME"  # Replace with your actual bucket name
 
 # Export the DuckDB database to a Parquet file
 duckdb data-prep/flows.duckdb "COPY station_flows TO 'data-prep/station_flows.parquet' (FORMAT parquet);"
+duckdb data-prep/flows.duckdb "COPY station_hourly_demand TO 'data-prep/station_hourly_demand.parquet' (FORMAT parquet);"
+duckdb data-prep/flows.duckdb "COPY (SELECT station_id, month, SUM(starts)::BIGINT AS starts, SUM(ends)::BIGINT AS ends FROM station_flows_hourly GROUP BY station_id, month) TO 'data-prep/station_flows_monthly' (FORMAT parquet, PARTITION_BY (month), OVERWRITE_OR_IGNORE, FILENAME_PATTERN 'flows_{i}');"
 
-# Upload the Parquet file to the Google Cloud Storage bucket
+# Upload the Parquet files to the Google Cloud Storage bucket
 gsutil cp data-prep/station_flows.parquet gs://$BUCKET_NAME/aggregated/
+gsutil cp data-prep/station_hourly_demand.parquet gs://$BUCKET_NAME/aggregated/
+gsutil -m cp -r data-prep/station_flows_monthly gs://$BUCKET_NAME/aggregated/
 
 # Clean up the local file (consider if you want to keep the parquet locally too)
 # rm data-prep/station_flows.parquet
+# rm -r data-prep/station_flows_monthly
 # rm data-prep/flows.duckdb # Optionally clean up the duckdb file too
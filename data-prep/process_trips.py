@@ -8,7 +8,7 @@ output_parquet_file = "data-prep/station_flows.parquet"
 duckdb_file = "data-prep/flows.duckdb"
 
 # Find all CSV files in the directory
-csv_files = glob.glob(os.path.join(csv_directory, "*.csv"))
+csv_files = sorted(glob.glob(os.path.join(csv_directory, "*.csv")))
 
 if not csv_files:
     print(f"No CSV files found in {csv_directory}")
@@ -16,48 +16,85 @@ else:
     # Connect to DuckDB. This will create a new database file if it doesn't exist.
     con = duckdb.connect(database=duckdb_file, read_only=False)
 
-    # Create a table from the CSV files
-    # DuckDB can directly read from a list of CSVs and handle schema detection.
-    # It's important to ensure all CSVs have consistent column names for 'start_station_id' and 'end_station_id'.
-    # The README mentions 'start_station_id' and 'end_station_id' are the fields you actually use.
-    # We'll assume these are the correct column names in your CSVs.
-    # If your CSVs have different date/time formats, you might need to specify parsing options.
-    # For simplicity, we'll assume DuckDB's auto-detection works.
-    print(f"Reading CSV files from {csv_directory} into DuckDB table 'trips'...")
-    con.execute(f"CREATE OR REPLACE TABLE trips AS SELECT start_station_id, end_station_id FROM read_csv_auto({csv_files}, union_by_name=true)")
+    # Flows are kept at station x month x hour-of-week resolution (0 = Sunday 00:00 … 167 = Saturday 23:00).
+    # Raw trips are never persisted: each CSV is aggregated straight from the scan and upserted into
+    # this table, so adding a new monthly file only reads that file.
+    # 'processed_csvs' records which files are already folded in.
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS station_flows_hourly (
+        station_id   VARCHAR,
+        month        VARCHAR,
+        hour_of_week INTEGER,
+        starts       BIGINT,
+        ends         BIGINT,
+        PRIMARY KEY (station_id, month, hour_of_week)
+    );
+    CREATE TABLE IF NOT EXISTS processed_csvs (
+        file_name    VARCHAR PRIMARY KEY,
+        processed_at TIMESTAMP
+    );
+    """)
 
-    # Aggregate data to get starts and ends per station
-    # Starts: count of trips originating from each station
-    # Ends: count of trips ending at each station
-    print("Aggregating trip data...")
-    query = """
+    # Older databases held the full raw 'trips' table; it's no longer needed
+    con.execute("DROP TABLE IF EXISTS trips")
+
+    processed = {row[0] for row in con.execute("SELECT file_name FROM processed_csvs").fetchall()}
+    new_csv_files = [f for f in csv_files if os.path.basename(f) not in processed]
+    print(f"Found {len(csv_files)} CSV files, {len(new_csv_files)} not yet processed")
+
+    # Each trip row is split into a start event and an end event in a single scan of the file.
+    # Starts are bucketed by started_at, ends by ended_at (a trip can cross an hour or month boundary).
+    # We'll assume 'start_station_id', 'end_station_id', 'started_at' and 'ended_at' are the column
+    # names in your CSVs. Both halves are cast to one type: a file whose start ids sniff as text
+    # and end ids as numbers would otherwise fail to build the list.
+    for csv_file in new_csv_files:
+        print(f"Aggregating {csv_file}...")
+        con.execute("BEGIN TRANSACTION")
+        try:
+            con.execute(f"""
+            INSERT INTO station_flows_hourly
+            SELECT e.station_id,
+                   strftime(e.at, '%Y-%m') AS month,
+                   dayofweek(e.at) * 24 + hour(e.at) AS hour_of_week,
+                   SUM(e.is_start)::BIGINT AS starts,
+                   SUM(1 - e.is_start)::BIGINT AS ends
+            FROM (
+                SELECT UNNEST([
+                    {{'station_id': start_station_id::VARCHAR, 'at': started_at::TIMESTAMP, 'is_start': 1}},
+                    {{'station_id': end_station_id::VARCHAR,   'at': ended_at::TIMESTAMP,   'is_start': 0}}
+                ]) AS e
+                FROM read_csv_auto('{csv_file}')
+            )
+            WHERE e.station_id IS NOT NULL AND e.at IS NOT NULL
+            GROUP BY 1, 2, 3
+            ON CONFLICT (station_id, month, hour_of_week) DO UPDATE
+                SET starts = starts + EXCLUDED.starts, ends = ends + EXCLUDED.ends
+            """)
+            con.execute("INSERT INTO processed_csvs VALUES (?, current_timestamp)", [os.path.basename(csv_file)])
+            con.execute("COMMIT")
+        except Exception:
+            # Leave the file unprocessed (and the table untouched) so a re-run picks it up
+            con.execute("ROLLBACK")
+            raise
+
+    # Roll the hourly table up into the two shapes the rollup reads.
+    # station_flows: all-time starts and ends per station
+    # station_hourly_demand: docking demand (ends) per station per hour-of-week, used to weight % time full
+    print("Rolling up station flows and hourly docking demand...")
+    con.execute("""
     CREATE OR REPLACE TABLE station_flows AS
-    WITH starts AS (
-        SELECT
-            start_station_id AS station_id,
-            COUNT(*) AS num_starts
-        FROM trips
-        WHERE start_station_id IS NOT NULL
-        GROUP BY start_station_id
-    ),
-    ends AS (
-        SELECT
-            end_station_id AS station_id,
-            COUNT(*) AS num_ends
-        FROM trips
-        WHERE end_station_id IS NOT NULL
-        GROUP BY end_station_id
-    )
-    SELECT
-        COALESCE(s.station_id, e.station_id) AS station_id,
-        COALESCE(s.num_starts, 0) AS starts,
-        COALESCE(e.num_ends, 0) AS ends
-    FROM starts s
-    FULL OUTER JOIN ends e ON s.station_id = e.station_id;
-    """
-    con.execute(query)
+    SELECT station_id, SUM(starts)::BIGINT AS starts, SUM(ends)::BIGINT AS ends
+    FROM station_flows_hourly
+    GROUP BY station_id;
+
+    CREATE OR REPLACE TABLE station_hourly_demand AS
+    SELECT station_id, hour_of_week, SUM(ends)::BIGINT AS ends
+    FROM station_flows_hourly
+    WHERE ends > 0
+    GROUP BY station_id, hour_of_week;
+    """)
 
-    print(f"Aggregation complete. Results are in the 'station_flows' table in {duckdb_file}")
+    print(f"Aggregation complete. Results are in the 'station_flows' and 'station_hourly_demand' tables in {duckdb_file}")
 
     # The export to Parquet is handled by export-and-upload.sh, so we don't do it here.
     # If you wanted to do it in Python:
@@ -66,4 +103,4 @@ else:
 
     # Close the connection
     con.close()
-    print("Process complete.") 
\ No newline at end of file
+    print("Process complete.")
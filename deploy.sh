@@ -24,6 +24,20 @@ else
     exit 1
 fi
 
+# GBFS systems every function works on (JSON list: id, station_status, station_information, timezone)
+DEFAULT_GBFS_SYSTEMS='[{"id": "divvy", "station_status": "https://gbfs.divvybikes.com/gbfs/en/station_status.json", "station_information": "https://gbfs.divvybikes.com/gbfs/en/station_information.json", "timezone": "America/Chicago"}]'
+GBFS_SYSTEMS="${GBFS_SYSTEMS:-$DEFAULT_GBFS_SYSTEMS}"
+
+# GBFS_SYSTEMS is a JSON list (it contains commas), so gcloud's delimiter is switched to |
+ENV_VARS="^|^BUCKET_NAME=$BUCKET_NAME|GCP_PROJECT=$GCP_PROJECT|GBFS_SYSTEMS=$GBFS_SYSTEMS"
+# The read API shortens its Cache-Control when outputs are republished on every tick,
+# and the scraper announces each live_status write on TICK_TOPIC
+TICK_TOPIC_ID="divvy-ticks"
+if [ "$STREAMING_ROLLUP" = "true" ]; then
+    ENV_VARS="$ENV_VARS|STREAMING_ROLLUP=true|TICK_TOPIC=projects/$GCP_PROJECT/topics/$TICK_TOPIC_ID"
+    gcloud pubsub topics describe $TICK_TOPIC_ID >/dev/null 2>&1 || gcloud pubsub topics create $TICK_TOPIC_ID
+fi
+
 # Function to deploy with error handling
 deploy_function() {
     local func_name=$1
@@ -41,7 +55,7 @@ deploy_function() {
         --entry-point=$entry_point \
         --trigger=http --allow-unauthenticated \
         --memory=$memory --timeout=$timeout \
-        --set-env-vars=BUCKET_NAME=$BUCKET_NAME,GCP_PROJECT=$GCP_PROJECT \
+        --set-env-vars="$ENV_VARS" \
         --max-instances=10
     
     if [ $? -eq 0 ]; then
@@ -58,7 +72,26 @@ echo "========================================"
 # Deploy all functions
 deploy_function "divvy-scraper" "scrapper" "grab" "256MiB" "60s"
 deploy_function "divvy-rollup" "rollup" "rollup" "1GiB" "300s"
+deploy_function "divvy-stations" "stations" "sync_stations" "256MiB" "60s"
 deploy_function "divvy-api" "api" "latest" "256MiB" "60s"
+deploy_function "divvy-api-history" "api" "history" "512MiB" "60s"
+deploy_function "divvy-api-live" "api" "live" "256MiB" "60s"
+
+# Optional streaming rollup: updates today's counters and live_dpi on every scraper tick
+# (triggered only by the scraper's TICK_TOPIC messages; --retry redelivers ticks that failed)
+if [ "$STREAMING_ROLLUP" = "true" ]; then
+    echo ""
+    echo "🚀 Deploying divvy-rollup-tick..."
+    gcloud functions deploy divvy-rollup-tick \
+        --gen2 --runtime=python312 --region=$REGION \
+        --source=./gcp-functions/rollup \
+        --entry-point=rollup_tick \
+        --trigger-topic=$TICK_TOPIC_ID --retry \
+        --memory=1GiB --timeout=120s \
+        --set-env-vars="$ENV_VARS" \
+        --max-instances=1
+    echo "✅ divvy-rollup-tick deployed successfully"
+fi
 
 echo ""
 echo "🎉 All functions deployed successfully!"
@@ -1,14 +1,406 @@
-import gzip, json, os
+import csv, gzip, io, json, os, time, zlib, tempfile, datetime as dt
+import duckdb
 from google.cloud import storage
 import functions_framework
+import pytz
 
 BUCKET = os.getenv('BUCKET_NAME', 'your-bucket-name')  # Replace with your bucket name
+ROLLUP_TIME = os.getenv('ROLLUP_TIME', '02:15')  # Daily rollup schedule (Central Time)
+GENERATION_CHECK_SECONDS = int(os.getenv('GENERATION_CHECK_SECONDS', '60'))
+# With the streaming rollup every scraper tick republishes the outputs, so they are only
+# cached briefly (and revalidated with the ETag) instead of until the next daily run
+STREAMING_ROLLUP = os.getenv('STREAMING_ROLLUP', '').lower() == 'true'
+STREAMING_MAX_AGE = 60
+# GBFS_SYSTEMS: JSON list from deploy.sh / config.env; "divvy" keeps the bucket root, other ids use systems/{id}/
+DEFAULT_SYSTEM = "divvy"
+SYSTEM_IDS = [s["id"] for s in json.loads(os.getenv('GBFS_SYSTEMS') or json.dumps([{"id": DEFAULT_SYSTEM}]))]
 client = storage.Client()
 
+# Precomputed rollup outputs served by name (?cube=); the default is live_dpi.json.gz
+CUBES_PREFIX = "aggregated/dpi_cubes"
+CUBES = ["7d", "30d", "90d", "30d_weekday", "30d_weekend", "heatmap"]
+DEFAULT_BLOB = "aggregated/live_dpi.json.gz"
+
+# Date-partitioned DPI history written by the rollup: date=YYYY-MM-DD/dpi.parquet
+HISTORY_PREFIX = "aggregated/dpi_history"
+HISTORY_MAX_DAYS = int(os.getenv('HISTORY_MAX_DAYS', '366'))  # Longest range one request may read
+HISTORY_DEFAULT_LIMIT = 10
+# Instance-local copies of history partitions, one file per blob generation
+HISTORY_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'divvy_dpi_history')
+
+# Newest station status, rewritten by the scraper on every changed tick (never listed)
+LIVE_STATUS_BLOB = "aggregated/live_status.json.gz"
+LIVE_MAX_DOCKS = int(os.getenv('LIVE_MAX_DOCKS', '2'))  # Default "nearly full": at most this many free docks
+LIVE_MAX_AGE = 60  # Cache-Control for the live endpoint (the feed changes every few minutes)
+
+# In-process caches of the stored gzip payloads, one per blob, keyed on the blob generation
+_caches = {}
+
+DPI_FIELDS = ["station_id", "station_name", "overflow_per_dock", "pct_full", "dpi"]
+HEATMAP_FIELDS = ["station_id", "station_name", "pct_full_by_hour"]
+LOCATION_FIELDS = ["lat", "lon"]
+
+def system_root(system_id):
+    """Blob prefix of a system's rollup outputs (None → DEFAULT_SYSTEM); raises ValueError for unknown systems."""
+    if system_id is None or system_id == DEFAULT_SYSTEM:
+        return ""
+    if system_id not in SYSTEM_IDS:
+        raise ValueError(f"unknown system {system_id!r}")
+    return f"systems/{system_id}/"
+
+def cube_blob(cube, root=""):
+    """Blob name for a cube name (None → live_dpi.json.gz); raises ValueError for unknown cubes."""
+    if cube is None:
+        return root + DEFAULT_BLOB
+    if cube not in CUBES:
+        raise ValueError(f"unknown cube {cube!r}; expected one of {', '.join(CUBES)}")
+    return f"{root}{CUBES_PREFIX}/{cube}.json.gz"
+
+def current_generation(blob_name):
+    """Return (generation, cache) for the blob, asking GCS at most once per GENERATION_CHECK_SECONDS."""
+    cache = _caches.setdefault(blob_name, {"generation": None, "checked_at": 0.0,
+                                           "gzip_body": None, "json_body": None, "index": None})
+    now = time.monotonic()
+    if cache["generation"] is not None and now - cache["checked_at"] < GENERATION_CHECK_SECONDS:
+        return cache["generation"], cache
+
+    blob = client.bucket(BUCKET).get_blob(blob_name)
+    if blob is None:
+        return None, cache
+    if blob.generation != cache["generation"]:
+        # New output: download the stored bytes once and serve them as-is
+        cache["gzip_body"] = blob.download_as_bytes()
+        cache["json_body"] = None
+        cache["index"] = None
+        cache["generation"] = blob.generation
+    cache["checked_at"] = now
+    return cache["generation"], cache
+
+def load_station_rows(root=""):
+    """Rows of a system's station_capacity.csv (station_id, legacy_id, name, lat, lon, capacity)."""
+    try:
+        text = client.bucket(BUCKET).blob(root + "station_capacity.csv").download_as_text()
+    except Exception as e:
+        print(f"Error loading station_capacity.csv: {e}")
+        return []
+    return list(csv.DictReader(io.StringIO(text)))
+
+def load_station_locations(root=""):
+    """Map legacy station id → (lat, lon) from a system's station_capacity.csv."""
+    return {
+        row["legacy_id"]: (float(row["lat"]), float(row["lon"]))
+        for row in load_station_rows(root)
+        if row["legacy_id"] and row["lat"] and row["lon"]
+    }
+
+def station_index(cache, root=""):
+    """Build (once per rollup generation) the in-memory index the query parameters run against.
+
+    Rows stay in DPI-descending order so `limit` is a prefix scan (the heatmap has
+    no dpi and keeps its stored order), `by_id` maps station_id → row position, and
+    lat/lon are joined in from station_capacity.csv (live_dpi station ids are the
+    legacy ids used in the capacity file).
+    """
+    if cache["index"] is None:
+        rows = sorted(json.loads(gzip.decompress(cache["gzip_body"])), key=lambda r: r.get("dpi") or 0, reverse=True)
+        locations = load_station_locations(root)
+        for row in rows:
+            row["lat"], row["lon"] = locations.get(str(row["station_id"]), (None, None))
+        cache["index"] = {
+            "rows": rows,
+            "by_id": {str(row["station_id"]): i for i, row in enumerate(rows)},
+        }
+    return cache["index"]
+
+def parse_query(args, fields=DPI_FIELDS):
+    """Validate limit/station_id/fields/bbox query parameters; raises ValueError with a message.
+
+    `fields` are the row fields of the cube being queried (the default projection).
+    """
+    query = {"limit": None, "station_ids": None, "fields": fields, "bbox": None}
+
+    if args.get("limit"):
+        query["limit"] = int(args["limit"])
+        if query["limit"] < 1:
+            raise ValueError("limit must be a positive integer")
+
+    if args.get("station_id"):
+        query["station_ids"] = [s.strip() for s in args["station_id"].split(",") if s.strip()]
+
+    if args.get("fields"):
+        query["fields"] = [f.strip() for f in args["fields"].split(",") if f.strip()]
+        unknown = set(query["fields"]) - set(fields + LOCATION_FIELDS)
+        if unknown:
+            raise ValueError(f"unknown fields: {', '.join(sorted(unknown))}")
+
+    if args.get("bbox"):
+        # GeoJSON order: min_lon,min_lat,max_lon,max_lat
+        parts = [float(v) for v in args["bbox"].split(",")]
+        if len(parts) != 4 or parts[0] > parts[2] or parts[1] > parts[3]:
+            raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+        query["bbox"] = parts
+
+    return query
+
+def run_query(index, query):
+    """Apply a parsed query to the station index; returns projected rows in DPI order."""
+    rows = index["rows"]
+    if query["station_ids"] is not None:
+        positions = sorted(index["by_id"][s] for s in query["station_ids"] if s in index["by_id"])
+        rows = [rows[i] for i in positions]
+
+    results = []
+    for row in rows:
+        if query["bbox"] is not None:
+            min_lon, min_lat, max_lon, max_lat = query["bbox"]
+            if row["lat"] is None or not (min_lat <= row["lat"] <= max_lat and min_lon <= row["lon"] <= max_lon):
+                continue
+        results.append({field: row.get(field) for field in query["fields"]})
+        if query["limit"] is not None and len(results) >= query["limit"]:
+            break
+    return results
+
+def seconds_until_next_rollup():
+    """Seconds from now until the next scheduled daily rollup run."""
+    central_tz = pytz.timezone('America/Chicago')
+    now = dt.datetime.now(central_tz)
+    hour, minute = (int(part) for part in ROLLUP_TIME.split(':'))
+    next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if next_run <= now:
+        next_run = central_tz.normalize(next_run + dt.timedelta(days=1))
+    return int((next_run - now).total_seconds())
+
+def output_max_age():
+    """Cache-Control max-age for rollup outputs (live_dpi, cubes, history)."""
+    if STREAMING_ROLLUP:
+        return STREAMING_MAX_AGE
+    # Output only changes when the daily rollup runs; allow a few minutes for it to finish
+    return seconds_until_next_rollup() + 300
+
+def etag_matches(if_none_match, etag):
+    """Check an If-None-Match header (possibly a list or weak validators) against our ETag."""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates
+
 @functions_framework.http
 def latest(request):
-    # Create a fresh blob reference on each request to avoid caching issues
-    blob = client.bucket(BUCKET).blob("aggregated/live_dpi.json.gz")
-    raw = blob.download_as_bytes()
-    data = json.loads(gzip.decompress(raw))
-    return (json.dumps(data), 200, {"Content-Type": "application/json"})
+    try:
+        root = system_root(request.args.get("system"))
+        blob_name = cube_blob(request.args.get("cube"), root)
+    except ValueError as e:
+        return (f"Invalid query: {e}", 400)
+    generation, cache = current_generation(blob_name)
+    if generation is None:
+        return (f"{blob_name.rsplit('/', 1)[-1]} not found", 404)
+
+    etag = f'"{generation}"'
+    headers = {
+        "Content-Type": "application/json",
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={output_max_age()}",
+        "Vary": "Accept-Encoding",
+    }
+
+    query_params = {k: request.args[k] for k in ("limit", "station_id", "fields", "bbox") if request.args.get(k)}
+    if query_params:
+        # Filtered responses are small; key the ETag on the query as well as the generation
+        query_key = json.dumps(query_params, sort_keys=True).encode()
+        headers["ETag"] = etag = f'"{generation}-{zlib.crc32(query_key):08x}"'
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return ("", 304, headers)
+        try:
+            query = parse_query(query_params, HEATMAP_FIELDS if request.args.get("cube") == "heatmap" else DPI_FIELDS)
+        except ValueError as e:
+            return (f"Invalid query: {e}", 400)
+        return (json.dumps(run_query(station_index(cache, root), query)), 200, headers)
+
+    # The gzip and identity bodies are different representations, so each gets its own validator
+    gzip_ok = "gzip" in request.headers.get("Accept-Encoding", "")
+    if not gzip_ok:
+        headers["ETag"] = etag = f'"{generation}-id"'
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return ("", 304, headers)
+
+    if gzip_ok:
+        return (cache["gzip_body"], 200, {**headers, "Content-Encoding": "gzip"})
+
+    # Rare client without gzip support: decompress once per generation
+    if cache["json_body"] is None:
+        cache["json_body"] = gzip.decompress(cache["gzip_body"])
+    return (cache["json_body"], 200, headers)
+
+def parse_history_query(args):
+    """Validate start/end/station_id/limit/rank for the history endpoint; raises ValueError."""
+    central_tz = pytz.timezone('America/Chicago')
+    try:
+        end = dt.date.fromisoformat(args["end"]) if args.get("end") else dt.datetime.now(central_tz).date()
+        start = dt.date.fromisoformat(args["start"]) if args.get("start") else end - dt.timedelta(days=29)
+    except ValueError:
+        raise ValueError("start and end must be YYYY-MM-DD dates")
+    if start > end:
+        raise ValueError("start must not be after end")
+    if (end - start).days + 1 > HISTORY_MAX_DAYS:
+        raise ValueError(f"range is limited to {HISTORY_MAX_DAYS} days")
+
+    query = {"start": start, "end": end, "station_ids": None, "limit": HISTORY_DEFAULT_LIMIT,
+             "rank": args.get("rank") or "dpi"}
+    if query["rank"] not in ("dpi", "change"):
+        raise ValueError("rank must be dpi or change")
+    if args.get("station_id"):
+        query["station_ids"] = [s.strip() for s in args["station_id"].split(",") if s.strip()]
+    if args.get("limit"):
+        query["limit"] = int(args["limit"])
+        if query["limit"] < 1:
+            raise ValueError("limit must be a positive integer")
+    return query
+
+def history_partitions(start, end, root=""):
+    """Local copies of a system's history partitions dated start..end (inclusive).
+
+    Only the date folders inside the range are listed (the listing is bounded by
+    start_offset/end_offset, which is the partition pruning), and each partition
+    is downloaded once per generation.
+    """
+    prefix = f"{root}{HISTORY_PREFIX}/date="
+    blobs = client.list_blobs(
+        BUCKET,
+        prefix=prefix,
+        start_offset=f"{prefix}{start.isoformat()}",
+        end_offset=f"{prefix}{(end + dt.timedelta(days=1)).isoformat()}",
+    )
+    paths = []
+    for blob in blobs:
+        if not blob.name.endswith(".parquet"):
+            continue
+        # Keep the date=YYYY-MM-DD folder so DuckDB reads the date from the path
+        folder = os.path.join(HISTORY_CACHE_DIR, root, blob.name.split("/")[-2])
+        local_path = os.path.join(folder, f"{blob.generation}.parquet")
+        if not os.path.exists(local_path):
+            os.makedirs(folder, exist_ok=True)
+            for stale in os.listdir(folder):
+                os.remove(os.path.join(folder, stale))
+            blob.download_to_filename(local_path)
+        paths.append(local_path)
+    return paths
+
+def run_history_query(paths, query):
+    """Per-station DPI series for the chosen stations, in rank order.
+
+    Without station_id the top `limit` stations are picked by their latest DPI in
+    the range (rank=dpi) or by how much it rose from their first day (rank=change).
+    """
+    con = duckdb.connect()
+    try:
+        con.execute(f"""
+            CREATE TEMP TABLE series AS
+            SELECT date, station_id, station_name, overflow_per_dock, pct_full, dpi
+            FROM read_parquet({paths}, hive_partitioning = true, hive_types = {{'date': DATE}})
+        """)
+        if query["station_ids"] is not None:
+            filter_sql, params = f"station_id IN ({', '.join('?' * len(query['station_ids']))})", query["station_ids"]
+        else:
+            filter_sql, params = "true", []
+        score = "arg_max(dpi, date)" if query["rank"] == "dpi" else "arg_max(dpi, date) - arg_min(dpi, date)"
+        chosen = con.execute(f"""
+            SELECT station_id, arg_max(station_name, date) AS station_name, ROUND({score}, 3) AS score
+            FROM series
+            WHERE {filter_sql}
+            GROUP BY station_id
+            ORDER BY score DESC NULLS LAST, station_id
+            LIMIT ?
+        """, params + [query["limit"] if query["station_ids"] is None else len(query["station_ids"])]).fetchall()
+
+        results = {station_id: {"station_id": station_id, "station_name": name, query["rank"]: score, "series": []}
+                   for station_id, name, score in chosen}
+        if results:
+            rows = con.execute(f"""
+                SELECT station_id, strftime(date, '%Y-%m-%d'), overflow_per_dock, pct_full, dpi
+                FROM series
+                WHERE station_id IN ({', '.join('?' * len(results))})
+                ORDER BY date
+            """, list(results)).fetchall()
+            for station_id, date_str, overflow_per_dock, pct_full, dpi in rows:
+                results[station_id]["series"].append(
+                    {"date": date_str, "overflow_per_dock": overflow_per_dock, "pct_full": pct_full, "dpi": dpi})
+        return list(results.values())
+    finally:
+        con.close()
+
+@functions_framework.http
+def history(request):
+    """DPI over a date range for given stations (?station_id=) or the top-N (?limit=, ?rank=dpi|change)."""
+    try:
+        root = system_root(request.args.get("system"))
+        query = parse_history_query(request.args)
+    except ValueError as e:
+        return (f"Invalid query: {e}", 400)
+
+    paths = history_partitions(query["start"], query["end"], root)
+    headers = {
+        "Content-Type": "application/json",
+        # New points arrive with the daily rollup (or every tick when streaming)
+        "Cache-Control": f"public, max-age={output_max_age()}",
+    }
+    if not paths:
+        return (json.dumps([]), 200, headers)
+    return (json.dumps(run_history_query(paths, query)), 200, headers)
+
+def live_index(cache, root=""):
+    """Parse (once per snapshot generation) the newest status joined with station names and capacity.
+
+    Rows are ordered fullest first: fewest free docks, then highest share of docks in use.
+    """
+    if cache["index"] is None:
+        doc = json.loads(gzip.decompress(cache["gzip_body"]))
+        stations = {row["station_id"]: row for row in load_station_rows(root)}
+        rows = []
+        for status in doc["stations"]:
+            info = stations.get(str(status["station_id"]), {})
+            capacity = int(info["capacity"]) if info.get("capacity") else None
+            docks = status.get("num_docks_available")
+            if docks is None:
+                continue
+            rows.append({
+                "station_id": info.get("legacy_id") or str(status["station_id"]),
+                "station_name": info.get("name"),
+                "capacity": capacity,
+                "num_docks_available": docks,
+                "num_bikes_available": status.get("num_bikes_available"),
+                "pct_docks_used": round(1 - docks / capacity, 3) if capacity else None,
+                "is_returning": status.get("is_returning"),
+                "last_reported": status.get("last_reported"),
+            })
+        rows.sort(key=lambda r: (r["num_docks_available"], -(r["pct_docks_used"] or 0)))
+        cache["index"] = {"timestamp": doc["timestamp"], "rows": rows}
+    return cache["index"]
+
+@functions_framework.http
+def live(request):
+    """Stations full or nearly full right now (?max_docks=, default LIVE_MAX_DOCKS; ?limit=)."""
+    try:
+        root = system_root(request.args.get("system"))
+        max_docks = int(request.args.get("max_docks", LIVE_MAX_DOCKS))
+        limit = int(request.args["limit"]) if request.args.get("limit") else None
+        if max_docks < 0 or (limit is not None and limit < 1):
+            raise ValueError("max_docks must be >= 0 and limit a positive integer")
+    except ValueError as e:
+        return (f"Invalid query: {e}", 400)
+
+    generation, cache = current_generation(root + LIVE_STATUS_BLOB)
+    if generation is None:
+        return ("live_status.json.gz not found", 404)
+
+    query_key = json.dumps([max_docks, limit]).encode()
+    etag = f'"{generation}-{zlib.crc32(query_key):08x}"'
+    headers = {"Content-Type": "application/json", "ETag": etag, "Cache-Control": f"public, max-age={LIVE_MAX_AGE}"}
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return ("", 304, headers)
+
+    index = live_index(cache, root)
+    # Stations not accepting returns can't be docked at anyway, so they aren't "full" for riders.
+    # Feeds send is_returning as a bool or as 0/1 (Divvy); a missing flag counts as returning.
+    rows = [r for r in index["rows"]
+            if r["num_docks_available"] <= max_docks and (r["is_returning"] is None or bool(r["is_returning"]))]
+    return (json.dumps({"timestamp": index["timestamp"], "stations": rows[:limit]}), 200, headers)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Rebuild aggregated/daily_pct_full/{date}.json for a range of days, in parallel.
+
+Each rebuilt aggregate records a `source` fingerprint: AGGREGATE_VERSION, the
+weighting inputs, and the versions of the snapshot objects it was built from
+(the day's compacted partition, or today's raw snapshots). A day is only
+recomputed when its fingerprint no longer matches. That covers changed source
+data, a changed aggregation (bump AGGREGATE_VERSION in main.py), and aggregates
+that are missing, unreadable or were written by the rollup itself. Every day is
+saved as soon as it finishes, so re-running the same command after an
+interruption resumes where it stopped.
+
+Days run in a process pool; every worker has its own GCS clients and its own
+in-memory DuckDB. Finished days that were never compacted are compacted first,
+exactly as the rollup would.
+
+Usage: python3 backfill.py --start 2026-09-01 --end 2026-09-30 [--system divvy] [--workers 4] [--dry-run] [--force]
+(needs BUCKET_NAME and GCP_PROJECT, like the function)
+"""
+
+import argparse
+import datetime as dt
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import gcsfs
+from google.cloud import storage
+
+from main import (
+    AGGREGATE_VERSION, BUCKET, COMPACTED_PREFIX, DEFAULT_SYSTEM, PCT_FULL_WEIGHTING, SYSTEMS,
+    capacity_source, compact_finished_days, compacted_path, create_daily_aggregate, daily_aggregate_path,
+    download_partitions, fetch_objects, load_hourly_demand, load_snapshots, local_tz, object_version,
+    open_state_db, save_daily_aggregate, snapshot_key, spool_snapshots, system_bucket, use_system,
+)
+
+# Per-process clients and DuckDB connection, set up once by init_worker
+_worker = {}
+
+
+def gcs_clients(system_id=DEFAULT_SYSTEM):
+    """(fs, bucket) for the configured GCS bucket, scoped to one system's prefix."""
+    fs = gcsfs.GCSFileSystem(project=os.environ["GCP_PROJECT"])
+    return fs, system_bucket(storage.Client().bucket(BUCKET), system_id)
+
+
+def weighting_versions(fs, bucket_name, weighted):
+    """Versions of the extra inputs a traffic-weighted aggregate depends on."""
+    if not weighted:
+        return ["weighted=False"]
+    paths = [f"{bucket_name}/aggregated/station_hourly_demand.parquet", capacity_source(fs, bucket_name)[0]]
+    return ["weighted=True"] + [f"{p}@{object_version(fs.info(p))}" for p in paths]
+
+
+def day_fingerprint(source_versions, weighting):
+    """Fingerprint of everything a daily aggregate is computed from."""
+    parts = [f"aggregate_version={AGGREGATE_VERSION}", *weighting, *sorted(source_versions)]
+    return hashlib.sha1("\n".join(parts).encode()).hexdigest()
+
+
+def init_worker(make_clients, weighted, threads, system_id=DEFAULT_SYSTEM):
+    """Process pool initializer: one set of clients and one DuckDB per worker."""
+    use_system(system_id)
+    fs, bucket = make_clients()
+    con = open_state_db(":memory:")
+    con.execute(f"SET threads = {threads}")
+    if weighted:
+        weighted = load_hourly_demand(con, fs, bucket.name)
+    _worker.update(fs=fs, bucket=bucket, con=con, weighted=weighted,
+                   weighting=weighting_versions(fs, bucket.name, weighted))
+
+
+def rebuild_day(date_str, raw_paths, today):
+    """Recompute and save one day's aggregate; returns (date, stations, seconds)."""
+    fs, bucket, con = _worker["fs"], _worker["bucket"], _worker["con"]
+    started = time.perf_counter()
+    partition = f"{bucket.name}/{compacted_path(date_str)}"
+
+    # Finished days are read from their compacted partition, compacting them first if needed
+    if date_str < today and not fs.exists(partition):
+        compact_finished_days(fs, bucket, con, sorted(raw_paths), dt.date.fromisoformat(today))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if fs.exists(partition):
+            source_versions = [f"{partition}@{object_version(fs.info(partition))}"]
+            load_snapshots(con, parquet_paths=download_partitions(fs, bucket.name, [date_str], temp_dir))
+            through, complete = f"{date_str.replace('-', '/')}/235959", True
+        elif raw_paths:
+            source_versions = [f"{p}@{v}" for p, v in raw_paths.items()]
+            spool = spool_snapshots(fs, sorted(raw_paths), os.path.join(temp_dir, "snapshots.json.gz"))
+            load_snapshots(con, json_paths=[spool])
+            through, complete = max(snapshot_key(p) for p in raw_paths), False
+        else:
+            return date_str, 0, time.perf_counter() - started
+
+    # A compacted day's snapshot files aren't listed, so its ticks are the distinct timestamps
+    daily_data = create_daily_aggregate(con, date_str, through, complete=complete, weighted=_worker["weighted"],
+                                        ticks=None if complete else len(raw_paths))
+    if daily_data is None:
+        return date_str, 0, time.perf_counter() - started
+    daily_data["source"] = day_fingerprint(source_versions, _worker["weighting"])
+    if not save_daily_aggregate(bucket, daily_data, replace=True):
+        raise RuntimeError(f"could not save the daily aggregate for {date_str}")
+    return date_str, len(daily_data["stations"]), time.perf_counter() - started
+
+
+def plan_backfill(fs, bucket_name, dates, today, weighted, force=False):
+    """Work out which days need recomputing; returns [(date, {raw path: version})].
+
+    One listing each for compacted partitions and stored aggregates, one per day
+    without a partition for its raw snapshots, plus a parallel read of the
+    stored aggregates' fingerprints.
+    """
+    weighting = weighting_versions(fs, bucket_name, weighted)
+    try:
+        partitions = fs.find(f"{bucket_name}/{COMPACTED_PREFIX}", detail=True)
+    except FileNotFoundError:
+        partitions = {}
+
+    stored = {}
+    if not force:
+        try:
+            names = set(fs.ls(f"{bucket_name}/aggregated/daily_pct_full", detail=False))
+        except FileNotFoundError:
+            names = set()
+        wanted = [d for d in dates if f"{bucket_name}/{daily_aggregate_path(d)}" in names]
+        gcs_paths = [f"{bucket_name}/{daily_aggregate_path(d)}" for d in wanted]
+        for date_str, (_, data) in zip(wanted, fetch_objects(fs, gcs_paths)):
+            try:
+                stored[date_str] = json.loads(data).get("source")
+            except ValueError:
+                print(f"Unreadable daily aggregate for {date_str}, will recompute")
+
+    plan = []
+    for date_str in dates:
+        partition = f"{bucket_name}/{compacted_path(date_str)}"
+        if partition in partitions:
+            raw_paths = {}
+            fingerprint = day_fingerprint([f"{partition}@{object_version(partitions[partition])}"], weighting)
+        else:
+            try:
+                listing = fs.ls(f"{bucket_name}/snapshots/{date_str.replace('-', '/')}", detail=True)
+            except FileNotFoundError:
+                listing = []
+            raw_paths = {info["name"]: object_version(info) for info in listing if info["name"].endswith(".json.gz")}
+            if not raw_paths:
+                print(f"No snapshots for {date_str}, skipping")
+                continue
+            # Finished days get compacted first, so their fingerprint isn't known until then
+            fingerprint = None if date_str < today else day_fingerprint(
+                [f"{p}@{v}" for p, v in raw_paths.items()], weighting)
+
+        if fingerprint is not None and stored.get(date_str) == fingerprint:
+            continue
+        plan.append((date_str, raw_paths))
+    return plan
+
+
+def backfill(start, end, workers, force=False, dry_run=False, make_clients=None, system_id=DEFAULT_SYSTEM):
+    """Rebuild the daily aggregates from start to end (inclusive); returns the dates that failed."""
+    use_system(system_id)
+    make_clients = make_clients or functools.partial(gcs_clients, system_id)
+    today = dt.datetime.now(local_tz()).date().isoformat()
+    weighted = PCT_FULL_WEIGHTING == 'traffic'
+    dates = [(start + dt.timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+
+    fs, bucket = make_clients()
+    plan = plan_backfill(fs, bucket.name, dates, today, weighted, force)
+    print(f"Days in range: {len(dates)}, to recompute: {len(plan)}")
+    if dry_run or not plan:
+        for date_str, raw_paths in plan:
+            print(f"  {date_str} ({len(raw_paths)} raw snapshots)" if raw_paths else f"  {date_str} (compacted)")
+        return []
+
+    # Split the cores between workers so the DuckDB instances don't oversubscribe them
+    workers = max(1, min(workers, len(plan)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    started = time.perf_counter()
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker, initargs=(make_clients, weighted, threads, system_id)) as pool:
+        futures = {pool.submit(rebuild_day, date_str, raw_paths, today): date_str for date_str, raw_paths in plan}
+        for done, future in enumerate(as_completed(futures), 1):
+            date_str = futures[future]
+            try:
+                _, stations, seconds = future.result()
+                print(f"✓ [{done}/{len(plan)}] {date_str}: {stations} stations in {seconds:.1f}s")
+            except Exception as e:
+                failed.append(date_str)
+                print(f"ERROR [{done}/{len(plan)}] {date_str}: {e}")
+
+    print(f"Backfill finished in {time.perf_counter() - started:.1f}s with {workers} workers, "
+          f"{len(plan) - len(failed)} rebuilt, {len(failed)} failed")
+    if failed:
+        print(f"Re-run the same command to retry: {', '.join(sorted(failed))}")
+    return failed
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Rebuild daily pct_full aggregates for a date range")
+    parser.add_argument("--system", default=DEFAULT_SYSTEM, choices=[s["id"] for s in SYSTEMS])
+    system_id = parser.parse_known_args()[0].system
+    use_system(system_id)
+    today = dt.datetime.now(local_tz()).date()
+    parser.add_argument("--start", type=dt.date.fromisoformat, default=today - dt.timedelta(days=29))
+    parser.add_argument("--end", type=dt.date.fromisoformat, default=today)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--force", action="store_true", help="recompute every day, ignoring fingerprints")
+    parser.add_argument("--dry-run", action="store_true", help="only list the days that would be recomputed")
+    args = parser.parse_args()
+
+    failed = backfill(args.start, min(args.end, today), args.workers, force=args.force, dry_run=args.dry_run,
+                      system_id=system_id)
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,10 +1,299 @@
-import os, datetime as dt, duckdb, gzip, json, gcsfs, tempfile
+import os, sys, time, resource, contextlib, base64, datetime as dt, duckdb, json, gcsfs, gzip, tempfile, zlib
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core import exceptions as gcs_exceptions
 from google.cloud import storage
-import pandas as pd
 import functions_framework
 import pytz
 
 BUCKET = os.getenv('BUCKET_NAME', 'your-bucket-name')  # Replace with your bucket name
+# GBFS_SYSTEMS: JSON list from deploy.sh / config.env; "divvy" keeps the bucket root, other ids use systems/{id}/
+DEFAULT_SYSTEM = "divvy"
+SYSTEMS = json.loads(os.getenv('GBFS_SYSTEMS') or json.dumps([{"id": DEFAULT_SYSTEM}]))
+COMPACTED_PREFIX = "aggregated/snapshots_daily"
+SNAPSHOTS_PER_DAY = 96  # Scraper cadence is every 15 minutes
+AGGREGATE_VERSION = 2  # Bump when daily aggregate logic changes so backfill.py recomputes every day
+PCT_FULL_WEIGHTING = os.getenv('PCT_FULL_WEIGHTING', 'none')  # 'none' or 'traffic' (weight by docking demand)
+FLOWS_WINDOW_MONTHS = int(os.getenv('FLOWS_WINDOW_MONTHS', '0'))  # 0 = all-time station_flows.parquet
+FLOWS_MONTHLY_PREFIX = "aggregated/station_flows_monthly"
+STATION_DIM_BLOB = "aggregated/station_dim.parquet"  # Versioned stations, kept by the stations sync function
+FETCH_CONCURRENCY = int(os.getenv('FETCH_CONCURRENCY', '16'))  # Parallel GCS reads per rollup
+# Instance-local DuckDB file that keeps dimensions and daily aggregates warm between invocations
+STATE_DB = os.getenv('STATE_DB', os.path.join(tempfile.gettempdir(), 'divvy_rollup_state.duckdb'))
+
+# Precomputed DPI cubes, all built from one set of daily aggregates: name → (window days, day type).
+# Each is written to CUBES_PREFIX/{name}.json.gz; live_dpi.json.gz stays a copy of LIVE_DPI_CUBE.
+DPI_CUBES = {
+    "7d": (7, "all"),
+    "30d": (30, "all"),
+    "90d": (90, "all"),
+    "30d_weekday": (30, "weekday"),
+    "30d_weekend": (30, "weekend"),
+}
+LIVE_DPI_CUBE = "30d"
+HEATMAP_CUBE = "heatmap"  # Hour-of-week pct_full per station over the longest window
+CUBES_PREFIX = "aggregated/dpi_cubes"
+CUBE_WINDOW_DAYS = max(days for days, _ in DPI_CUBES.values())
+DPI_HISTORY_PREFIX = "aggregated/dpi_history"  # date=YYYY-MM-DD/dpi.parquet: each day's LIVE_DPI_CUBE rows
+
+# Full station state of the newest tick, written by the scraper; it then publishes the
+# blob's generation to the TICK_TOPIC Pub/Sub topic, which drives rollup_tick
+LIVE_STATUS_BLOB = "aggregated/live_status.json.gz"
+TICK_MERGE_ATTEMPTS = 5  # Retries when a tick (or the batch) updated the same daily aggregate first
+
+RUN_HISTORY_BLOB = "aggregated/rollup_runs.jsonl"  # One JSON run record per line, newest last
+RUN_HISTORY_MAX = int(os.getenv('RUN_HISTORY_MAX', '1000'))  # Run records kept in RUN_HISTORY_BLOB
+
+# json_transform structure of a daily aggregate (current counts and the legacy pct_full-only format)
+DAILY_JSON_STRUCTURE = json.dumps({"stations": [{
+    "station_id": "VARCHAR", "full_count": "DOUBLE", "sample_count": "DOUBLE",
+    "weighted_full": "DOUBLE", "weight_total": "DOUBLE", "pct_full": "DOUBLE",
+    "hour_full": ["DOUBLE"], "hour_samples": ["DOUBLE"],
+}]})
+
+# Explicit schema for raw snapshots (full keyframes, deltas and legacy full copies):
+# only the fields the rollup uses are parsed and no schema inference is needed
+SNAPSHOT_JSON_COLUMNS = """{
+    timestamp: 'TIMESTAMPTZ',
+    keyframe: 'BOOLEAN',
+    stations: 'STRUCT(station_id VARCHAR, num_docks_available INTEGER, num_bikes_available INTEGER, is_returning BOOLEAN, last_reported BIGINT)[]'
+}"""
+
+# Run record of the rollup in progress and the stage spans currently open (innermost last)
+_run = None
+_open_spans = []
+
+# Local timezone of the system being rolled up: snapshot folders and hour-of-week are in it
+_timezone = "America/Chicago"
+
+def system_config(system_id):
+    """The SYSTEMS entry for one system id; raises KeyError for unknown systems."""
+    for system in SYSTEMS:
+        if system["id"] == system_id:
+            return system
+    raise KeyError(f"unknown system {system_id!r}")
+
+def system_root(system_id):
+    """Blob prefix of one system's snapshots and aggregates ('' for DEFAULT_SYSTEM)."""
+    return "" if system_id == DEFAULT_SYSTEM else f"systems/{system_id}/"
+
+def use_system(system_id):
+    """Switch the module to one system's timezone before rolling it up."""
+    global _timezone
+    _timezone = system_config(system_id).get("timezone", "America/Chicago")
+
+def local_tz():
+    """pytz timezone of the system being rolled up."""
+    return pytz.timezone(_timezone)
+
+class SystemBucket:
+    """Bucket view that keeps one system's blobs under its prefix.
+
+    `name` carries the prefix too, so the f"{bucket.name}/..." gcsfs paths used
+    throughout the rollup land under the same folder as bucket.blob() writes.
+    """
+    def __init__(self, bucket, prefix):
+        self._bucket = bucket
+        self.prefix = prefix
+        self.name = f"{bucket.name}/{prefix.rstrip('/')}"
+
+    def blob(self, name, **kwargs):
+        return self._bucket.blob(self.prefix + name, **kwargs)
+
+    def get_blob(self, name):
+        return self._bucket.get_blob(self.prefix + name)
+
+def system_bucket(bucket, system_id):
+    """The bucket itself for DEFAULT_SYSTEM, otherwise a SystemBucket under systems/{id}/."""
+    prefix = system_root(system_id)
+    return SystemBucket(bucket, prefix) if prefix else bucket
+
+def state_db_path(system_id):
+    """Warm-state DuckDB file for one system (daily aggregates and dimensions differ per system)."""
+    if system_id == DEFAULT_SYSTEM:
+        return STATE_DB
+    root, ext = os.path.splitext(STATE_DB)
+    return f"{root}_{system_id}{ext}"
+
+def memory_mb():
+    """(current, peak) resident set size of this process in MB.
+
+    Read from /proc/self/status where available; elsewhere the current size is
+    unknown and the peak falls back to ru_maxrss (the whole process lifetime).
+    """
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["VmRSS"].split()[0]) / 1024, int(fields["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return None, peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def reset_peak_memory():
+    """Reset the kernel's peak-RSS mark (Linux) so each stage reports its own peak."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def track_peak_memory():
+    """Fold the peak RSS since the last reset into the run and every open span."""
+    _, peak = memory_mb()
+    for record in [_run, *_open_spans]:
+        record["peak_rss_mb"] = max(record["peak_rss_mb"], peak)
+
+def count_read(objects, nbytes):
+    """Add objects/bytes read from GCS to the run and every open span."""
+    if _run is None:
+        return
+    for record in [_run, *_open_spans]:
+        record["objects"] += objects
+        record["bytes_read"] += nbytes
+
+@contextlib.contextmanager
+def stage(name):
+    """Record one rollup stage as a span on the current run record.
+
+    A stage opened inside another gets a dotted name ("daily_aggregates.fetch"),
+    and re-entering a stage (once per day, say) adds to the same span. Spans keep
+    calls, duration, objects and bytes read, rows (set by the caller on the
+    yielded dict), peak RSS while the stage ran and RSS when it ended.
+    """
+    if _run is None:
+        yield {"rows": 0}
+        return
+    
+    full_name = f"{_open_spans[-1]['stage']}.{name}" if _open_spans else name
+    span = next((s for s in _run["spans"] if s["stage"] == full_name), None)
+    if span is None:
+        span = {"stage": full_name, "calls": 0, "duration_s": 0.0, "objects": 0, "bytes_read": 0,
+                "rows": 0, "peak_rss_mb": 0.0, "rss_mb": None}
+        _run["spans"].append(span)
+    span["calls"] += 1
+    
+    track_peak_memory()
+    reset_peak_memory()
+    _open_spans.append(span)
+    started = time.perf_counter()
+    try:
+        yield span
+    finally:
+        span["duration_s"] += time.perf_counter() - started
+        track_peak_memory()
+        _open_spans.pop()
+        span["rss_mb"] = memory_mb()[0]
+
+def begin_run():
+    """Start a fresh run record for this invocation."""
+    global _run
+    _open_spans.clear()
+    _run = {"started_at": dt.datetime.now(dt.timezone.utc).isoformat(), "mode": None, "snapshots": 0,
+            "objects": 0, "bytes_read": 0, "peak_rss_mb": 0.0, "spans": [], "_started": time.perf_counter()}
+    reset_peak_memory()
+
+def finish_run(bucket, result=None, error=None):
+    """Close the run record, log it as one JSON line and append it to RUN_HISTORY_BLOB."""
+    global _run
+    track_peak_memory()
+    record, _run = _run, None
+    record["duration_s"] = round(time.perf_counter() - record.pop("_started"), 3)
+    record["status"] = result[1] if result else 500
+    record["result"] = result[0] if result else f"error: {error}"
+    record["peak_rss_mb"] = round(record["peak_rss_mb"], 1)
+    for span in record["spans"]:
+        span["duration_s"] = round(span["duration_s"], 3)
+        span["peak_rss_mb"] = round(span["peak_rss_mb"], 1)
+        span["rss_mb"] = round(span["rss_mb"], 1) if span["rss_mb"] is not None else None
+    
+    # Structured log line (Cloud Logging parses JSON lines into jsonPayload)
+    print(json.dumps({"severity": "INFO" if record["status"] == 200 else "ERROR",
+                      "message": "rollup run record", "run": record}))
+    
+    try:
+        blob = bucket.blob(RUN_HISTORY_BLOB)
+        lines = blob.download_as_text().splitlines() if blob.exists() else []
+        lines = (lines + [json.dumps(record)])[-RUN_HISTORY_MAX:]
+        blob.upload_from_string("\n".join(lines) + "\n", content_type="application/x-ndjson")
+    except Exception as e:
+        print(f"Error saving run record: {e}")
+    return record
+
+def open_state_db(path=STATE_DB):
+    """Open the warm-state DuckDB file, recreating it if a previous instance left it unreadable."""
+    try:
+        con = duckdb.connect(path)
+    except duckdb.Error as e:
+        print(f"State DB unreadable, starting fresh: {e}")
+        if os.path.exists(path):
+            os.remove(path)
+        con = duckdb.connect(path)
+    con.sql("CREATE TABLE IF NOT EXISTS source_versions (name VARCHAR PRIMARY KEY, version VARCHAR, refreshed_at TIMESTAMP)")
+    con.sql("CREATE TABLE IF NOT EXISTS daily_aggregates (date VARCHAR PRIMARY KEY, version VARCHAR, body VARCHAR)")
+    return con
+
+def object_version(info):
+    """Version token for one object from fs.info()/fs.ls(detail=True) metadata."""
+    return f"{info.get('generation') or info.get('etag') or info.get('mtime')}:{info.get('size')}"
+
+def refresh_dimension(con, fs, table, gcs_paths, select_sql):
+    """(Re)build a cached dimension table only when its source objects changed.
+
+    The version of every source object (GCS generation) is compared with the one
+    recorded in source_versions; if nothing changed the table from the previous
+    invocation is reused as-is. The query is part of the version too, so a changed
+    `select_sql` rebuilds the table. `select_sql` is formatted with `paths`, the
+    local copies of gcs_paths. Returns True if the table was rebuilt.
+    """
+    version = "|".join(f"{path}@{object_version(fs.info(path))}" for path in gcs_paths)
+    version += f"#{zlib.crc32(select_sql.encode()):08x}"
+    cached = con.execute("SELECT version FROM source_versions WHERE name = ?", [table]).fetchone()
+    table_exists = con.execute(
+        "SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = ? AND NOT temporary", [table]
+    ).fetchone()[0]
+    if cached and cached[0] == version and table_exists:
+        print(f"✓ {table} unchanged, using cached table")
+        return False
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_paths = []
+        for i, (gcs_path, data) in enumerate(fetch_objects(fs, gcs_paths)):
+            local_path = os.path.join(temp_dir, f"{table}_{i}_{os.path.basename(gcs_path)}")
+            with open(local_path, 'wb') as dst:
+                dst.write(data)
+            local_paths.append(local_path)
+        con.sql(f"CREATE OR REPLACE TABLE {table} AS {select_sql.format(paths=local_paths)}")
+    
+    con.execute("INSERT OR REPLACE INTO source_versions VALUES (?, ?, now())", [table, version])
+    print(f"✓ Refreshed {table} from {len(gcs_paths)} files")
+    return True
+
+def capacity_source(fs, bucket_name):
+    """Source object and SELECT for the `cap` table.
+
+    Prefers the versioned station dimension kept by the stations sync function
+    (typed, rewritten only when a station changes), taking each station's latest
+    version so stations retired during the window still join. A station that got
+    a new id keeps its legacy_id, so one legacy_id can have several rows here;
+    effective_from tells which is current. Falls back to the manually uploaded
+    station_capacity.csv.
+    """
+    dim_path = f"{bucket_name}/{STATION_DIM_BLOB}"
+    if fs.exists(dim_path):
+        return dim_path, """
+            SELECT station_id, legacy_id, name, lat, lon, capacity, effective_from
+            FROM read_parquet('{paths[0]}')
+            QUALIFY row_number() OVER (PARTITION BY station_id ORDER BY effective_from DESC) = 1
+        """
+    return f"{bucket_name}/station_capacity.csv", """
+        SELECT station_id::VARCHAR AS station_id, legacy_id::VARCHAR AS legacy_id, name, lat, lon, capacity,
+               NULL::TIMESTAMPTZ AS effective_from
+        FROM read_csv_auto('{paths[0]}')
+    """
+
+def refresh_capacity(con, fs, bucket_name):
+    """Cache the station dimension (or station_capacity.csv) as the `cap` table."""
+    source_path, select_sql = capacity_source(fs, bucket_name)
+    refresh_dimension(con, fs, "cap", [source_path], select_sql)
 
 def get_last_processed_timestamp(bucket):
     """Get the last processed timestamp from GCS state file."""
@@ -27,134 +316,684 @@ def save_last_processed_timestamp(bucket, timestamp):
     except Exception as e:
         print(f"Error saving last processed timestamp: {e}")
 
-def get_snapshots_since(fs, bucket_name, since_timestamp, central_tz):
-    """Get snapshot paths since the given timestamp."""
-    all_paths = fs.glob(f"{bucket_name}/snapshots/*/*/*/*.json.gz")
-    
+def list_snapshots(fs, bucket_name, start_date, end_date):
+    """List snapshot paths for each date folder from start_date to end_date (inclusive).
+
+    Lists one snapshots/YYYY/MM/DD/ prefix per day instead of globbing the whole
+    bucket, so the cost scales with the days asked for rather than total history.
+    """
+    paths = []
+    current_date = start_date
+    while current_date <= end_date:
+        prefix = f"{bucket_name}/snapshots/{current_date:%Y/%m/%d}"
+        try:
+            paths.extend(sorted(p for p in fs.ls(prefix, detail=False) if p.endswith('.json.gz')))
+        except FileNotFoundError:
+            pass
+        current_date += dt.timedelta(days=1)
+    return paths
+
+def get_snapshots_since(snapshot_paths, since_timestamp, tz):
+    """Filter snapshot paths to those written after the given timestamp."""
     if since_timestamp is None:
         # First run - return all paths
-        return all_paths
+        return list(snapshot_paths)
     
-    filtered_paths = []
-    for path in all_paths:
+    # Paths are snapshots/YYYY/MM/DD/HHMMSS.json.gz in Central Time, so a plain
+    # string comparison against the watermark in the same layout is enough
+    watermark = f"{since_timestamp.astimezone(tz):%Y/%m/%d/%H%M%S}"
+    return [p for p in snapshot_paths if snapshot_key(p) > watermark]
+
+def snapshot_key(path):
+    """Extract the sortable YYYY/MM/DD/HHMMSS key from a snapshot path."""
+    return "/".join(path.split('/')[-4:]).replace('.json.gz', '')
+
+def snapshot_date(path):
+    """Extract the YYYY-MM-DD date from a snapshots/YYYY/MM/DD/HHMMSS.json.gz path."""
+    return "-".join(path.split('/')[-4:-1])
+
+def compacted_path(date_str):
+    """Blob path of the compacted Parquet partition for one day."""
+    return f"{COMPACTED_PREFIX}/date={date_str}/snapshots.parquet"
+
+def snapshot_key_time(key, tz=None):
+    """Central-time datetime a YYYY/MM/DD/HHMMSS snapshot key was written at."""
+    return (tz or local_tz()).localize(dt.datetime.strptime(key, "%Y/%m/%d/%H%M%S"))
+
+def load_snapshots(con, json_paths=(), parquet_paths=(), min_ts=None):
+    """Load raw JSON snapshots and compacted Parquet partitions into one flat `snaps` table.
+
+    Raw snapshots are either keyframes (every station) or deltas holding only the
+    stations that changed since the previous tick; legacy full snapshots count as
+    keyframes. Per-tick state is rebuilt with ASOF joins: every tick takes each
+    station's latest record at or before it, as long as that record isn't older
+    than the tick's base keyframe (so stations dropped from the feed stop counting).
+    Ticks before `min_ts` only provide state and aren't emitted. Returns the row count.
+    """
+    selects = []
+    if parquet_paths:
+        selects.append(f"SELECT * FROM read_parquet({list(parquet_paths)})")
+    if json_paths:
+        con.sql(f"""
+            CREATE OR REPLACE TEMP TABLE snapshot_docs AS
+            SELECT "timestamp" AS ts, COALESCE(keyframe, true) AS keyframe, stations
+            FROM read_json({list(json_paths)}, format='unstructured', columns={SNAPSHOT_JSON_COLUMNS})
+        """)
+        con.sql("""
+            CREATE OR REPLACE TEMP TABLE snapshot_records AS
+            SELECT unnest.station_id, d.ts, unnest.num_docks_available, unnest.num_bikes_available,
+                   unnest.is_returning, unnest.last_reported
+            FROM snapshot_docs d
+            CROSS JOIN UNNEST(d.stations) AS unnest
+        """)
+        min_ts_filter = f"WHERE t.ts >= '{min_ts.isoformat()}'::TIMESTAMPTZ" if min_ts is not None else ""
+        selects.append(f"""
+            WITH ticks AS (
+                SELECT t.ts, k.ts AS keyframe_ts
+                FROM snapshot_docs t
+                ASOF JOIN (SELECT ts FROM snapshot_docs WHERE keyframe) k ON t.ts >= k.ts
+                {min_ts_filter}
+            )
+            SELECT s.station_id, t.ts, r.num_docks_available, r.num_bikes_available,
+                   r.is_returning, r.last_reported
+            FROM ticks t
+            CROSS JOIN (SELECT DISTINCT station_id FROM snapshot_records) s
+            ASOF JOIN snapshot_records r ON r.station_id = s.station_id AND t.ts >= r.ts
+            WHERE r.ts >= t.keyframe_ts
+        """)
+    con.sql("CREATE OR REPLACE TEMP TABLE snaps AS " + " UNION ALL BY NAME ".join(selects))
+    return con.sql("SELECT COUNT(*) FROM snaps").fetchone()[0]
+
+def fetch_objects(fs, gcs_paths, max_workers=FETCH_CONCURRENCY):
+    """Yield (path, bytes) for each object, fetched in order by a bounded thread pool."""
+    if not gcs_paths:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(gcs_paths)))) as pool:
+        for gcs_path, data in zip(gcs_paths, pool.map(fs.cat_file, gcs_paths)):
+            count_read(1, len(data))
+            yield gcs_path, data
+
+def spool_snapshots(fs, gcs_paths, spool_path, max_workers=FETCH_CONCURRENCY):
+    """Download raw snapshots concurrently into a single spool file.
+
+    Each snapshot is its own gzip member, so appending the compressed bytes as-is
+    yields one valid .json.gz holding all documents back to back, which
+    read_json_auto(format='unstructured') reads in a single scan.
+    """
+    with open(spool_path, 'wb') as spool:
+        for _, data in fetch_objects(fs, gcs_paths, max_workers):
+            spool.write(data)
+    return spool_path
+
+def compact_finished_days(fs, bucket, con, snapshot_paths, today, since_date=None):
+    """Fold each finished day's raw snapshots into a single Parquet partition.
+
+    Days before `today` that don't have a partition yet are read once, flattened to
+    one row per station per snapshot and written to
+    aggregated/snapshots_daily/date=YYYY-MM-DD/snapshots.parquet. Raw snapshots are
+    left in place (the bucket lifecycle rule expires them). Returns the dates that
+    were compacted on this run.
+    """
+    paths_by_date = {}
+    for path in snapshot_paths:
+        date_str = snapshot_date(path)
+        if date_str >= today.isoformat():
+            continue
+        if since_date is not None and date_str < since_date.isoformat():
+            continue
+        paths_by_date.setdefault(date_str, []).append(path)
+
+    compacted = []
+    for date_str, date_paths in sorted(paths_by_date.items()):
+        if fs.exists(f"{bucket.name}/{compacted_path(date_str)}"):
+            continue
+
+        print(f"Compacting {len(date_paths)} snapshots for {date_str}")
         try:
-            # Extract date and time from path: snapshots/YYYY/MM/DD/HHMMSS.json.gz
-            path_parts = path.split('/')
-            date_str = "/".join(path_parts[2:5])  # YYYY/MM/DD
-            time_str = path_parts[5].replace('.json.gz', '')  # HHMMSS
-            
-            # Parse the snapshot timestamp
-            snapshot_dt = dt.datetime.strptime(f"{date_str} {time_str}", "%Y/%m/%d %H%M%S")
-            snapshot_dt = central_tz.localize(snapshot_dt)
-            
-            if snapshot_dt > since_timestamp:
-                filtered_paths.append(path)
+            with tempfile.TemporaryDirectory() as temp_dir:
+                with stage("fetch"):
+                    spool = spool_snapshots(fs, date_paths, os.path.join(temp_dir, "snapshots.json.gz"))
+                with stage("parse") as span:
+                    span["rows"] += load_snapshots(con, json_paths=[spool])
+                parquet_local = os.path.join(temp_dir, "snapshots.parquet")
+                with stage("write"):
+                    con.sql(f"""
+                        COPY (SELECT * FROM snaps ORDER BY station_id, ts)
+                        TO '{parquet_local}' (FORMAT PARQUET, COMPRESSION ZSTD)
+                    """)
+                with stage("upload"):
+                    bucket.blob(compacted_path(date_str)).upload_from_filename(
+                        parquet_local, content_type="application/octet-stream"
+                    )
+            compacted.append(date_str)
         except Exception as e:
-            print(f"Error parsing timestamp from path {path}: {e}")
-            continue
+            print(f"Error compacting snapshots for {date_str}: {e}")
+
+    print(f"Compacted {len(compacted)} finished days")
+    return compacted
+
+def download_partitions(fs, bucket_name, dates, temp_dir):
+    """Download the compacted Parquet partition for each date; returns local paths."""
+    gcs_paths = [f"{bucket_name}/{compacted_path(date_str)}" for date_str in dates]
+    local_paths = []
+    for date_str, (_, data) in zip(dates, fetch_objects(fs, gcs_paths)):
+        local_path = os.path.join(temp_dir, f"snapshots_{date_str}.parquet")
+        with open(local_path, 'wb') as dst:
+            dst.write(data)
+        local_paths.append(local_path)
+    return local_paths
+
+def load_hourly_demand(con, fs, bucket_name):
+    """Cache per-station docking demand by hour-of-week as a `demand` table keyed on GBFS station_id.
+
+    station_hourly_demand.parquet is keyed on the legacy ids used in the trip CSVs,
+    so it's mapped through the `cap` table. Returns False if either source is missing.
+    """
+    try:
+        refresh_capacity(con, fs, bucket_name)
+        refresh_dimension(
+            con, fs, "demand",
+            [f"{bucket_name}/aggregated/station_hourly_demand.parquet", capacity_source(fs, bucket_name)[0]],
+            """
+            SELECT cap.station_id::VARCHAR AS station_id,
+                   d.hour_of_week::INTEGER AS hour_of_week,
+                   d.ends::DOUBLE          AS weight
+            FROM read_parquet('{paths[0]}') d
+            JOIN cap ON d.station_id::VARCHAR = cap.legacy_id::VARCHAR
+            """,
+        )
+    except Exception as e:
+        print(f"ERROR loading hourly demand inputs, using unweighted pct_full: {e}")
+        return False
     
-    return filtered_paths
+    print(f"Hourly demand records: {con.sql('SELECT COUNT(*) FROM demand').fetchone()[0]}")
+    return True
 
-def create_daily_aggregate(con, snapshots_for_date, date_str):
-    """Create daily pct_full aggregate for a specific date."""
-    if not snapshots_for_date:
-        return None
+def create_daily_aggregate(con, date_str, through, complete=False, weighted=False, ticks=None):
+    """Create additive full/sample counts per station for the snapshots loaded in `snaps`.
+
+    Counts (not averages) are stored so partial days can be merged and the rolling
+    window weights every snapshot equally; hour_full / hour_samples split them by
+    local hour for the hour-of-week heatmap. `through` is the latest snapshot key
+    covered, `ticks` the number of snapshot files counted (default: the distinct
+    timestamps in `snaps`) and `complete` marks a day built from its full
+    compacted partition.
+    With weighted=True each snapshot is also weighted by the station's docking
+    demand in that hour-of-week (the `demand` table) in the same pass.
+    """
+    weighted_cols = """,
+                   SUM((s.num_docks_available = 0)::INT * COALESCE(d.weight, 0)) AS weighted_full,
+                   SUM(COALESCE(d.weight, 0))                                     AS weight_total""" if weighted else ""
+    weighted_join = f"""
+            LEFT JOIN demand d
+                   ON d.station_id = s.station_id
+                  AND d.hour_of_week = dayofweek(s.ts AT TIME ZONE '{_timezone}') * 24
+                                     + hour(s.ts AT TIME ZONE '{_timezone}')""" if weighted else ""
+    weighted_totals = """,
+               SUM(weighted_full) AS weighted_full,
+               SUM(weight_total)  AS weight_total""" if weighted else ""
     
-    # Calculate pct_full for this date's snapshots
-    pct_full_result = con.sql("""
-        SELECT unnest.station_id,
-               AVG((unnest.num_docks_available = 0)::INT) AS pct_full
-        FROM snaps
-        CROSS JOIN UNNEST(stations) AS unnest
+    # Counts per station per local hour first; the day totals and the 24-slot
+    # hour_full / hour_samples lists (zero-filled) both come from them
+    counts_result = con.sql(f"""
+        WITH hourly AS (
+            SELECT s.station_id,
+                   hour(s.ts AT TIME ZONE '{_timezone}') AS hour,
+                   SUM((s.num_docks_available = 0)::INT)     AS full_count,
+                   COUNT(*)                                  AS sample_count{weighted_cols}
+            FROM snaps s{weighted_join}
+            GROUP BY 1, 2
+        ),
+        grid AS (
+            SELECT st.station_id, h.hour
+            FROM (SELECT DISTINCT station_id FROM hourly) st
+            CROSS JOIN range(24) h(hour)
+        )
+        SELECT g.station_id,
+               SUM(COALESCE(hourly.full_count, 0))::BIGINT                       AS full_count,
+               SUM(COALESCE(hourly.sample_count, 0))::BIGINT                     AS sample_count{weighted_totals},
+               list(COALESCE(hourly.full_count, 0)::BIGINT ORDER BY g.hour)      AS hour_full,
+               list(COALESCE(hourly.sample_count, 0)::BIGINT ORDER BY g.hour)    AS hour_samples
+        FROM grid g
+        LEFT JOIN hourly ON hourly.station_id = g.station_id AND hourly.hour = g.hour
         GROUP BY 1
-    """).df()
+    """)
     
-    if len(pct_full_result) == 0:
+    # One small record per station straight from the result rows (no DataFrame in between)
+    columns = counts_result.columns
+    stations = [dict(zip(columns, row)) for row in counts_result.fetchall()]
+    if not stations:
         return None
     
-    # Convert to dictionary format for JSON storage
+    if ticks is None:
+        ticks = con.sql("SELECT COUNT(DISTINCT ts) FROM snaps").fetchone()[0]
+    
     daily_data = {
         "date": date_str,
-        "stations": pct_full_result.to_dict('records')
+        "through": through,
+        "ticks": ticks,
+        "complete": complete,
+        "stations": stations
     }
     
     return daily_data
 
-def save_daily_aggregate(bucket, daily_data):
-    """Save daily aggregate to GCS."""
+def merge_daily_aggregates(existing, new):
+    """Add the counts of a newer partial aggregate into an existing one for the same day."""
+    if existing is None:
+        return new
+    if new is None:
+        return existing
+    
+    merged = {s["station_id"]: dict(s) for s in daily_station_counts(existing)}
+    for station in new["stations"]:
+        current = merged.setdefault(station["station_id"], {"station_id": station["station_id"]})
+        for stat in ("full_count", "sample_count", "weighted_full", "weight_total"):
+            if stat in station:
+                current[stat] = current.get(stat, 0) + station[stat]
+        for stat in ("hour_full", "hour_samples"):
+            if stat in station:
+                previous = current.get(stat) or [0] * len(station[stat])
+                current[stat] = [a + b for a, b in zip(previous, station[stat])]
+    
+    return {
+        "date": new["date"],
+        "through": max(existing.get("through") or "", new["through"]),
+        # Unknown (None) once either side predates the tick count
+        "ticks": existing["ticks"] + new["ticks"] if existing.get("ticks") is not None and new.get("ticks") is not None else None,
+        "complete": new["complete"],
+        "stations": list(merged.values())
+    }
+
+def daily_station_counts(daily_data):
+    """Return a daily aggregate's per-station counts, upgrading the legacy pct_full-only format."""
+    stations = daily_data["stations"]
+    if stations and "sample_count" not in stations[0]:
+        # Legacy records only kept the day's average; weight them as a full day of ticks
+        return [
+            {"station_id": s["station_id"],
+             "full_count": s["pct_full"] * SNAPSHOTS_PER_DAY,
+             "sample_count": SNAPSHOTS_PER_DAY}
+            for s in stations
+        ]
+    return stations
+
+def counts_every_snapshot(daily_data, day_paths):
+    """True if an aggregate has counted every one of the day's snapshots up to its `through`.
+
+    A tick the streaming rollup missed (or a pre-`ticks` aggregate) leaves the
+    count short, and the day then has to be rebuilt from its snapshots.
+    """
+    through = daily_data.get("through") or ""
+    return daily_data.get("ticks") == sum(1 for p in day_paths if snapshot_key(p) <= through)
+
+def daily_aggregate_path(date_str):
+    """Blob path of the daily aggregate for one day."""
+    return f"aggregated/daily_pct_full/{date_str}.json"
+
+def parse_daily_aggregate(body, date_str):
+    """Parse a stored daily aggregate body, or return None (and log it) if it's unreadable."""
+    try:
+        daily_data = json.loads(body)
+    except ValueError as e:
+        print(f"Skipping unreadable daily aggregate for {date_str}: {e}")
+        return None
+    if not isinstance(daily_data, dict) or not isinstance(daily_data.get("stations"), list):
+        print(f"Skipping malformed daily aggregate for {date_str}: no stations list")
+        return None
+    return daily_data
+
+def load_daily_aggregate(fs, bucket_name, date_str):
+    """Load one day's aggregate, or None if it doesn't exist yet (or can't be read)."""
+    try:
+        with fs.open(f"{bucket_name}/{daily_aggregate_path(date_str)}", 'rb') as f:
+            body = f.read()
+    except FileNotFoundError:
+        return None
+    count_read(1, len(body))
+    return parse_daily_aggregate(body, date_str)
+
+def save_daily_aggregate(bucket, daily_data, replace=False):
+    """Save daily aggregate to GCS without undoing streaming tick merges.
+
+    Like apply_tick, the write is conditional on the generation just read and
+    retried if a tick merged into the blob in between. `through` never moves
+    backwards: a stored aggregate that already covers later snapshots is kept, and
+    unless `replace` is set, so is one covering exactly the same snapshots. An
+    unreadable stored body counts as covering nothing and is overwritten.
+    Returns False if the aggregate couldn't be saved.
+    """
     if daily_data is None:
-        return
+        return True
     
     date_str = daily_data["date"]
-    blob_path = f"aggregated/daily_pct_full/{date_str}.json"
     
     try:
-        blob = bucket.blob(blob_path)
-        blob.upload_from_string(json.dumps(daily_data), content_type="application/json")
-        print(f"Saved daily aggregate for {date_str}")
+        for _ in range(TICK_MERGE_ATTEMPTS):
+            stored = bucket.get_blob(daily_aggregate_path(date_str))
+            if stored is not None:
+                stored_data = parse_daily_aggregate(stored.download_as_bytes(), date_str)
+                stored_through = (stored_data or {}).get("through") or ""
+                if stored_through > daily_data["through"] or (stored_through == daily_data["through"] and not replace):
+                    print(f"Kept daily aggregate for {date_str} (already through {stored_through})")
+                    return True
+            try:
+                bucket.blob(daily_aggregate_path(date_str)).upload_from_string(
+                    json.dumps(daily_data), content_type="application/json",
+                    if_generation_match=stored.generation if stored is not None else 0)
+                print(f"Saved daily aggregate for {date_str}")
+                return True
+            except gcs_exceptions.PreconditionFailed:
+                print(f"Daily aggregate for {date_str} changed while saving, retrying")
+        print(f"Error saving daily aggregate for {date_str}: gave up after {TICK_MERGE_ATTEMPTS} attempts")
     except Exception as e:
         print(f"Error saving daily aggregate for {date_str}: {e}")
+    return False
+
+def update_daily_aggregates(fs, bucket, con, snapshot_paths, temp_dir, merge=True, weighted=False, context_paths=None):
+    """Build daily aggregates for every date touched by snapshot_paths and save them.
 
-def load_daily_aggregates(fs, bucket_name, days=30):
-    """Load the last N days of daily aggregates."""
-    central_tz = pytz.timezone('America/Chicago')
-    end_date = dt.datetime.now(central_tz).date()
+    Dates with a compacted partition are rebuilt from the complete day, unless
+    merge=True and the stored aggregate (kept current by rollup_tick) has already
+    counted every snapshot through the day's last one. Other dates are aggregated
+    from the given raw snapshots; with merge=True those counts are added to the
+    stored aggregate (skipping snapshots it already covers), otherwise they
+    replace it. A stored aggregate that missed a tick is rebuilt from the whole
+    day instead. Delta snapshots need the day's earlier files to rebuild state,
+    so raw days are read from `context_paths` (the full listing of those days)
+    and only the new ticks are counted. With weighted=True the traffic-weighted
+    sums are stored too. Returns {date: daily_data}.
+    """
+    snapshots_by_date = {}
+    for gcs_path in snapshot_paths:
+        snapshots_by_date.setdefault(snapshot_date(gcs_path), []).append(gcs_path)
+    day_paths = {}
+    for gcs_path in (context_paths or snapshot_paths):
+        day_paths.setdefault(snapshot_date(gcs_path), []).append(gcs_path)
+    
+    compacted_dates = [d for d in sorted(snapshots_by_date) if fs.exists(f"{bucket.name}/{compacted_path(d)}")]
+    covered = {}
+    # Tick counts can only be checked against a full listing of each day
+    check_ticks = merge and context_paths is not None
+    if check_ticks:
+        # Finished days the streaming rollup counted to the end need no rescan
+        with stage("fetch"):
+            for date_str in compacted_dates:
+                stored = load_daily_aggregate(fs, bucket.name, date_str)
+                day_end = max(snapshot_key(p) for p in day_paths[date_str])
+                if (stored is not None and (stored.get("through") or "") >= day_end
+                        and counts_every_snapshot(stored, day_paths[date_str])):
+                    covered[date_str] = stored
+        compacted_dates = [d for d in compacted_dates if d not in covered]
+    with stage("fetch"):
+        parquet_by_date = dict(zip(compacted_dates, download_partitions(fs, bucket.name, compacted_dates, temp_dir)))
+    print(f"Days to aggregate: {len(snapshots_by_date)} ({len(compacted_dates)} from compacted partitions, "
+          f"{len(covered)} already counted by ticks)")
+    
+    if weighted:
+        weighted = load_hourly_demand(con, fs, bucket.name)
+    
+    results = {}
+    for i, (date_str, date_paths) in enumerate(sorted(snapshots_by_date.items())):
+        through = max(snapshot_key(p) for p in date_paths)
+        read_paths = sorted(p for p in day_paths.get(date_str, date_paths) if snapshot_key(p) <= through)
+        replace = not merge
+        
+        if date_str in covered:
+            results[date_str] = covered[date_str]
+            continue
+        if date_str in parquet_by_date:
+            # Finished day: the whole compacted partition replaces whatever was stored
+            print(f"Processing compacted partition for {date_str}")
+            with stage("parse") as span:
+                span["rows"] += load_snapshots(con, parquet_paths=[parquet_by_date[date_str]])
+            with stage("aggregate") as span:
+                daily_data = create_daily_aggregate(con, date_str, through, complete=True, weighted=weighted,
+                                                    ticks=len(read_paths))
+                span["rows"] += len(daily_data["stations"]) if daily_data else 0
+            replace = True
+        else:
+            with stage("fetch"):
+                existing = load_daily_aggregate(fs, bucket.name, date_str) if merge else None
+            if check_ticks and existing is not None and not counts_every_snapshot(existing, day_paths[date_str]):
+                print(f"Daily aggregate for {date_str} missed snapshots, rebuilding the whole day")
+                existing, replace = None, True
+            min_ts = None
+            if existing is not None and existing.get("through"):
+                date_paths = [p for p in date_paths if snapshot_key(p) > existing["through"]]
+                if not date_paths:
+                    results[date_str] = existing
+                    continue
+                # Snapshot timestamps land within a second of the key they're stored under
+                min_ts = snapshot_key_time(existing["through"]) + dt.timedelta(seconds=1)
+            
+            print(f"Processing {len(date_paths)} snapshots for {date_str} ({len(read_paths)} read for state)")
+            with stage("fetch"):
+                spool = spool_snapshots(fs, read_paths, os.path.join(temp_dir, f"snapshots_{i}.json.gz"))
+            with stage("parse") as span:
+                span["rows"] += load_snapshots(con, json_paths=[spool], min_ts=min_ts)
+            with stage("aggregate") as span:
+                new_counts = create_daily_aggregate(con, date_str, through, weighted=weighted,
+                                                    ticks=len(date_paths) if existing is not None else len(read_paths))
+                span["rows"] += len(new_counts["stations"]) if new_counts else 0
+                daily_data = merge_daily_aggregates(existing, new_counts)
+        
+        with stage("upload"):
+            saved = save_daily_aggregate(bucket, daily_data, replace=replace)
+        if daily_data is not None and saved:
+            results[date_str] = daily_data
+    
+    return results
+
+def load_daily_aggregates(fs, bucket_name, con, days=30):
+    """Bring the last N days of daily aggregates into the state DB; returns their dates.
+
+    Bodies are cached in the `daily_aggregates` table keyed on their blob generation,
+    so a warm instance only downloads the days that changed since its last run.
+    Each body is checked when it is downloaded; unreadable days are logged and left
+    out of the window (and the cache).
+    """
+    end_date = dt.datetime.now(local_tz()).date()
     start_date = end_date - dt.timedelta(days=days-1)
     
-    all_station_data = []
+    try:
+        stored = {info["name"]: object_version(info) for info in fs.ls(f"{bucket_name}/aggregated/daily_pct_full", detail=True)}
+    except FileNotFoundError:
+        stored = {}
+    cached = dict(con.execute("SELECT date, version FROM daily_aggregates").fetchall())
     
+    wanted, changed = [], []
     for i in range(days):
-        current_date = start_date + dt.timedelta(days=i)
-        date_str = current_date.strftime("%Y-%m-%d")
-        blob_path = f"{bucket_name}/aggregated/daily_pct_full/{date_str}.json"
-        
-        try:
-            with fs.open(blob_path, 'r') as f:
-                daily_data = json.load(f)
-                all_station_data.extend(daily_data["stations"])
-        except Exception as e:
-            print(f"Daily aggregate not found for {date_str}: {e}")
+        date_str = (start_date + dt.timedelta(days=i)).strftime("%Y-%m-%d")
+        version = stored.get(f"{bucket_name}/{daily_aggregate_path(date_str)}")
+        if version is None:
+            print(f"Daily aggregate not found for {date_str}")
             continue
+        wanted.append(date_str)
+        if cached.get(date_str) != version:
+            changed.append(date_str)
     
-    if not all_station_data:
-        return None
+    print(f"Daily aggregates in window: {len(wanted)} ({len(changed)} downloaded, rest cached)")
+    gcs_paths = [f"{bucket_name}/{daily_aggregate_path(d)}" for d in changed]
+    for date_str, (_, data) in zip(changed, fetch_objects(fs, gcs_paths)):
+        # An unreadable day would make the json_transform over the whole window fail; leave it out
+        if parse_daily_aggregate(data, date_str) is None:
+            con.execute("DELETE FROM daily_aggregates WHERE date = ?", [date_str])
+            wanted.remove(date_str)
+            continue
+        con.execute("INSERT OR REPLACE INTO daily_aggregates VALUES (?, ?, ?)",
+                    [date_str, stored[f"{bucket_name}/{daily_aggregate_path(date_str)}"], data.decode()])
     
-    # Convert to DataFrame and calculate average pct_full across all days
-    df = pd.DataFrame(all_station_data)
-    if len(df) == 0:
-        return None
+    return wanted
+
+def dpi_history_path(date_str):
+    """Blob path of one day's partition of the DPI history series."""
+    return f"{DPI_HISTORY_PREFIX}/date={date_str}/dpi.parquet"
+
+def save_dpi_history(con, bucket, date_str, temp_dir):
+    """Write the live cube's per-station metrics as the day's DPI history partition.
+
+    The date lives in the partition path (hive style), so readers prune by listing
+    a date range of folders and only open the files inside it.
+    """
+    local_path = os.path.join(temp_dir, f"dpi_history_{date_str}.parquet")
+    con.sql(f"""
+        COPY (
+            SELECT station_id::VARCHAR AS station_id, station_name, overflow_per_dock, pct_full, dpi
+            FROM dpi
+            WHERE cube = '{LIVE_DPI_CUBE}'
+            ORDER BY station_id
+        ) TO '{local_path}' (FORMAT PARQUET, COMPRESSION ZSTD)
+    """)
+    bucket.blob(dpi_history_path(date_str)).upload_from_filename(local_path, content_type="application/octet-stream")
+    print(f"Saved DPI history for {date_str}")
+
+def load_window_counts(con, dates):
+    """Unnest the cached daily JSON bodies once into the `daily_counts` table every cube reads.
+
+    Reads the given dates straight from the state DB's `daily_aggregates` table, so
+    the documents are never parsed in Python. One row per station per day with the
+    day's counts and its 24-slot hour lists. Legacy pct_full-only records count as
+    a full day of ticks, as in daily_station_counts, and have no hour lists.
+    Stations are keyed on their legacy_id from `cap` (the id the flows and outputs
+    use), so the counts of a station that got a new feed id add up under one key.
+    Returns the row count.
+    """
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE daily_counts AS
+        WITH counts AS (
+            SELECT date::DATE AS date,
+                   unnest(json_transform(body, '{DAILY_JSON_STRUCTURE}').stations, recursive := true)
+            FROM daily_aggregates
+            WHERE date IN ({', '.join('?' * len(dates))})
+        )
+        SELECT c.date, COALESCE(m.legacy_id, c.station_id) AS station_id,
+               COALESCE(c.full_count, c.pct_full * {SNAPSHOTS_PER_DAY}) AS full_count,
+               COALESCE(c.sample_count, {SNAPSHOTS_PER_DAY})            AS sample_count,
+               COALESCE(c.weighted_full, 0)                              AS weighted_full,
+               COALESCE(c.weight_total, 0)                               AS weight_total,
+               c.hour_full, c.hour_samples
+        FROM counts c
+        LEFT JOIN (SELECT DISTINCT station_id, legacy_id::VARCHAR AS legacy_id FROM cap WHERE legacy_id IS NOT NULL) m
+               ON m.station_id = c.station_id
+    """, list(dates))
+    return con.sql("SELECT COUNT(*) FROM daily_counts").fetchone()[0]
+
+def cube_pct_full(con, end_date, weighted=False):
+    """Build the `pct_full` table (cube, station_id, pct_full) for every cube in DPI_CUBES.
+
+    All windows and day-type splits come out of one grouped pass over `daily_counts`:
+    each day row is matched to every cube whose window and day type it falls in.
+    With weighted=True it's the demand-weighted share instead; stations (or days)
+    without demand data fall back to the unweighted counts. Returns {cube: stations}.
+    """
+    con.execute("CREATE OR REPLACE TEMP TABLE cube_defs (cube VARCHAR, start_date DATE, day_type VARCHAR)")
+    con.executemany("INSERT INTO cube_defs VALUES (?, ?, ?)", [
+        [cube, end_date - dt.timedelta(days=days - 1), day_type]
+        for cube, (days, day_type) in DPI_CUBES.items()
+    ])
+    pct_full_expr = "CASE WHEN weight_total > 0 THEN weighted_full / weight_total ELSE full_count / sample_count END" \
+        if weighted else "full_count / sample_count"
+    con.sql(f"""
+        CREATE OR REPLACE TEMP TABLE pct_full AS
+        WITH totals AS (
+            SELECT c.cube, d.station_id,
+                   SUM(d.full_count)    AS full_count,
+                   SUM(d.sample_count)  AS sample_count,
+                   SUM(d.weighted_full) AS weighted_full,
+                   SUM(d.weight_total)  AS weight_total
+            FROM daily_counts d
+            JOIN cube_defs c
+              ON d.date BETWEEN c.start_date AND DATE '{end_date}'
+             AND (c.day_type = 'all'
+                  OR (dayofweek(d.date) IN (0, 6)) = (c.day_type = 'weekend'))
+            GROUP BY 1, 2
+        )
+        SELECT cube, station_id, {pct_full_expr} AS pct_full
+        FROM totals
+        WHERE sample_count > 0
+    """)
+    return dict(con.sql("SELECT cube, COUNT(*) FROM pct_full GROUP BY 1").fetchall())
+
+def hour_of_week_pct_full(con):
+    """Build the `heatmap` table: a 168-slot pct_full list per station (Sunday 00h first).
+
+    Hour slots come from each day's hour_full / hour_samples lists in `daily_counts`;
+    a slot with no samples in the window is NULL. Returns the station count.
+    """
+    con.sql("""
+        CREATE OR REPLACE TEMP TABLE heatmap AS
+        WITH slots AS (
+            SELECT d.station_id,
+                   dayofweek(d.date) * 24 + h.hour AS hour_of_week,
+                   SUM(d.hour_full[h.hour + 1])    AS full_count,
+                   SUM(d.hour_samples[h.hour + 1]) AS sample_count
+            FROM daily_counts d
+            CROSS JOIN range(24) h(hour)
+            WHERE d.hour_samples IS NOT NULL
+            GROUP BY 1, 2
+        ),
+        grid AS (
+            SELECT st.station_id, w.hour_of_week
+            FROM (SELECT DISTINCT station_id FROM slots) st
+            CROSS JOIN range(168) w(hour_of_week)
+        )
+        SELECT g.station_id,
+               list(ROUND(s.full_count / NULLIF(s.sample_count, 0), 3) ORDER BY g.hour_of_week) AS pct_full_by_hour
+        FROM grid g
+        LEFT JOIN slots s ON s.station_id = g.station_id AND s.hour_of_week = g.hour_of_week
+        GROUP BY 1
+    """)
+    return con.sql("SELECT COUNT(*) FROM heatmap").fetchone()[0]
+
+def list_flow_months(fs, bucket_name, window_months):
+    """Pick the most recent `window_months` month=YYYY-MM flow partitions and list their files.
+
+    Only the partition folder names are listed to choose months; files are listed
+    (and later read) for the chosen months alone. Trip data is published a month
+    or so late, so the window is the newest months available, not calendar months.
+    """
+    month_dirs = sorted(
+        p.rstrip('/') for p in fs.ls(f"{bucket_name}/{FLOWS_MONTHLY_PREFIX}", detail=False)
+        if p.rstrip('/').split('/')[-1].startswith("month=")
+    )
+    chosen = month_dirs[-window_months:]
+    print(f"Flow months in window: {[d.split('=')[-1] for d in chosen]}")
+    return [p for d in chosen for p in sorted(fs.ls(d, detail=False)) if p.endswith('.parquet')]
+
+def station_flow_paths(fs, bucket_name, window_months=FLOWS_WINDOW_MONTHS):
+    """Source objects for station flows: the all-time file, or only the recent monthly partitions."""
+    if window_months <= 0:
+        return [f"{bucket_name}/aggregated/station_flows.parquet"]
     
-    # Group by station_id and average the pct_full values
-    result = df.groupby('station_id')['pct_full'].mean().reset_index()
-    return result
+    gcs_paths = list_flow_months(fs, bucket_name, window_months)
+    if not gcs_paths:
+        raise FileNotFoundError(f"no partitions under {FLOWS_MONTHLY_PREFIX}")
+    return gcs_paths
+
+def earliest_snapshot_date(fs, bucket_name):
+    """Find the oldest snapshot date by walking the YYYY/MM/DD folder names."""
+    path = f"{bucket_name}/snapshots"
+    for _ in range(3):
+        children = sorted(
+            p.rstrip('/') for p in fs.ls(path, detail=False)
+            if p.rstrip('/').split('/')[-1].isdigit()
+        )
+        if not children:
+            return None
+        path = children[0]
+    return dt.datetime.strptime("/".join(path.split('/')[-3:]), "%Y/%m/%d").date()
 
 def should_use_incremental_processing(fs, bucket_name):
     """Determine if we should use incremental processing or full processing."""
-    central_tz = pytz.timezone('America/Chicago')
-    
     # Check how many days of data we have
     try:
-        all_paths = fs.glob(f"{bucket_name}/snapshots/*/*/*/*.json.gz")
-        if len(all_paths) == 0:
-            return False
-        
-        # Get the earliest snapshot date
-        earliest_date = None
-        for path in all_paths:
-            try:
-                path_parts = path.split('/')
-                date_str = "/".join(path_parts[2:5])  # YYYY/MM/DD
-                snapshot_date = dt.datetime.strptime(date_str, "%Y/%m/%d").date()
-                if earliest_date is None or snapshot_date < earliest_date:
-                    earliest_date = snapshot_date
-            except:
-                continue
-        
+        earliest_date = earliest_snapshot_date(fs, bucket_name)
         if earliest_date is None:
             return False
         
         # If we have less than 3 days of data, use full processing
-        days_of_data = (dt.datetime.now(central_tz).date() - earliest_date).days
+        days_of_data = (dt.datetime.now(local_tz()).date() - earliest_date).days
         return days_of_data >= 3
         
     except Exception as e:
@@ -163,194 +1002,345 @@ def should_use_incremental_processing(fs, bucket_name):
 
 @functions_framework.http
 def rollup(request):
-    """Aggregate snapshots → live_dpi.json.gz with incremental processing."""
+    """Aggregate snapshots → live_dpi.json.gz and the DPI cubes with incremental processing.
+
+    Rolls up only ?system=<id> (the scheduler runs one job per system, so each gets
+    the whole function timeout), or every configured system in turn when called
+    without it. Each system has its own storage prefix, timezone, state DB and run
+    record, and a failing system doesn't stop the others.
+    """
     print(f"=== ROLLUP DEBUG START ===")
     print(f"Using bucket: {BUCKET}")
     
-    # Initialize gcsfs and storage client
+    system_ids = [s["id"] for s in SYSTEMS]
+    if request.args.get("system"):
+        if request.args["system"] not in system_ids:
+            return (f"unknown system {request.args['system']!r}", 400)
+        system_ids = [request.args["system"]]
+    
+    # Initialize gcsfs and storage client. gcsfs instances are reused across warm
+    # invocations, so drop any listings cached by a previous run.
     fs = gcsfs.GCSFileSystem(project=os.environ["GCP_PROJECT"])
+    fs.invalidate_cache()
     client = storage.Client()
-    bucket = client.bucket(BUCKET)
     
-    # Use Central Time for date calculations
-    central_tz = pytz.timezone('America/Chicago')
-    now = dt.datetime.now(central_tz)
+    results = []
+    for system_id in system_ids:
+        print(f"--- System: {system_id} ---")
+        con = open_state_db(state_db_path(system_id))
+        try:
+            body, status = run_rollup(fs, system_bucket(client.bucket(BUCKET), system_id), con, system_id=system_id)
+        except Exception as e:
+            print(f"ERROR rolling up {system_id}: {e}")
+            body, status = f"error: {e}", 500
+        finally:
+            con.close()
+        results.append((system_id, body, status))
+    
+    if len(results) == 1:
+        return results[0][1:]
+    summary = "\n".join(f"{system_id}: {body}" for system_id, body, _ in results)
+    return (summary, max(status for _, _, status in results))
+
+@functions_framework.cloud_event
+def rollup_tick(cloud_event):
+    """Streaming rollup: fold one scraper tick into the daily counters and republish live_dpi.
+
+    Triggered by the scraper's Pub/Sub message for each live_status.json.gz it
+    writes ({"system": id, "generation": n}). A tick that couldn't be merged
+    raises, so Pub/Sub redelivers it.
+    """
+    message = json.loads(base64.b64decode(cloud_event.data["message"]["data"]))
+    system_id = message["system"]
+    if system_id not in {s["id"] for s in SYSTEMS}:
+        print(f"Ignoring tick for unknown system {system_id!r}")
+        return
+    
+    use_system(system_id)
+    fs = gcsfs.GCSFileSystem(project=os.environ["GCP_PROJECT"])
+    fs.invalidate_cache()
+    bucket = system_bucket(storage.Client().bucket(BUCKET), system_id)
+    con = open_state_db(state_db_path(system_id))
+    try:
+        body, status = apply_tick(fs, bucket, con, int(message["generation"]))
+    finally:
+        con.close()
+    print(json.dumps({"severity": "INFO" if status == 200 else "ERROR",
+                      "message": "rollup tick", "system": system_id, "result": body}))
+    if status != 200:
+        raise RuntimeError(f"rollup tick failed for {system_id}: {body}")
+
+def apply_tick(fs, bucket, con, generation=None):
+    """Add one tick's counts to its day's aggregate, then rebuild the outputs from the aggregates.
+
+    The tick is the given generation of live_status (a full station list), so
+    it's counted exactly like one snapshot in the batch rollup (O(stations)). The
+    aggregate's `through` key makes this idempotent: a redelivered or
+    out-of-order tick that is already covered is skipped. The write is
+    conditional on the generation read, so concurrent ticks retry instead of
+    overwriting each other; raises if the tick still couldn't be merged. A tick
+    whose generation is already gone is left to the daily rollup, which rebuilds
+    any day whose `ticks` count falls short. Returns (body, status).
+    """
+    weighted = PCT_FULL_WEIGHTING == 'traffic'
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_path = os.path.join(temp_dir, "live_status.json.gz")
+        try:
+            data = bucket.blob(LIVE_STATUS_BLOB, generation=generation).download_as_bytes()
+        except gcs_exceptions.NotFound:
+            return (f"live_status generation {generation} already replaced, left to the daily rollup", 200)
+        with open(local_path, 'wb') as f:
+            f.write(data)
+        with gzip.open(local_path) as f:
+            snapshot = json.load(f)["snapshot"]
+        through, date_str = snapshot_key(snapshot), snapshot_date(snapshot)
+        load_snapshots(con, json_paths=[local_path])
+        if weighted:
+            weighted = load_hourly_demand(con, fs, bucket.name)
+        tick_counts = create_daily_aggregate(con, date_str, through, weighted=weighted, ticks=1)
+    if tick_counts is None:
+        return (f"empty tick {through}", 200)
+    
+    for _ in range(TICK_MERGE_ATTEMPTS):
+        stored = bucket.get_blob(daily_aggregate_path(date_str))
+        existing = parse_daily_aggregate(stored.download_as_bytes(), date_str) if stored is not None else None
+        if existing is not None and existing.get("through") and through <= existing["through"]:
+            return (f"tick {through} already counted", 200)
+        try:
+            bucket.blob(daily_aggregate_path(date_str)).upload_from_string(
+                json.dumps(merge_daily_aggregates(existing, tick_counts)), content_type="application/json",
+                if_generation_match=stored.generation if stored is not None else 0)
+            break
+        except gcs_exceptions.PreconditionFailed:
+            print(f"Daily aggregate for {date_str} changed during tick {through}, retrying")
+    else:
+        raise RuntimeError(f"gave up merging tick {through} after {TICK_MERGE_ATTEMPTS} attempts")
+    
+    now = dt.datetime.now(local_tz())
+    window_dates = load_daily_aggregates(fs, bucket.name, con, days=CUBE_WINDOW_DAYS)
+    body, status = publish_outputs(fs, bucket, con, window_dates, now, weighted=weighted)
+    return (f"tick {through}: {body}", status)
+
+def run_rollup(fs, bucket, con, mode=None, system_id=DEFAULT_SYSTEM):
+    """Run the rollup stages under a run record that is logged and appended to RUN_HISTORY_BLOB.
+
+    `bucket` is already scoped to the system (see system_bucket).
+    """
+    use_system(system_id)
+    begin_run()
+    _run["system"] = system_id
+    result, error = None, None
+    try:
+        result = rollup_stages(fs, bucket, con, mode)
+        return result
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        finish_run(bucket, result, error)
+
+def rollup_stages(fs, bucket, con, mode=None):
+    """Rollup body: `con` is the warm-state DuckDB connection shared by every stage.
+
+    `mode` forces 'full' or 'incremental' processing (used by the benchmarks);
+    by default it is picked from how much snapshot data exists.
+    """
+    # Use the system's local time for date calculations (snapshot folders are in it)
+    tz = local_tz()
+    now = dt.datetime.now(tz)
+    bucket_name = bucket.name
+    
+    since = now - dt.timedelta(days=30)
+    weighted = PCT_FULL_WEIGHTING == 'traffic'
+    print(f"pct_full weighting: {PCT_FULL_WEIGHTING}")
     
     # Check if we should use incremental processing
-    use_incremental = should_use_incremental_processing(fs, BUCKET)
+    with stage("list"):
+        if mode is None:
+            use_incremental = should_use_incremental_processing(fs, bucket_name)
+        else:
+            use_incremental = mode == 'incremental'
     print(f"Using incremental processing: {use_incremental}")
     
     if use_incremental:
+        _run["mode"] = "incremental"
         # Get last processed timestamp
         last_processed = get_last_processed_timestamp(bucket)
         print(f"Last processed timestamp: {last_processed}")
         
+        # List only the date folders from the watermark onwards
+        start_date = since.date()
+        if last_processed is not None:
+            start_date = max(start_date, last_processed.astimezone(tz).date())
+        with stage("list") as span:
+            listed_paths = list_snapshots(fs, bucket_name, start_date, now.date())
+            span["rows"] += len(listed_paths)
+        print(f"Snapshot files listed since {start_date}: {len(listed_paths)}")
+        
+        # Fold finished days into one Parquet partition each before reading anything
+        with stage("compact"):
+            compact_finished_days(fs, bucket, con, listed_paths, now.date(), since_date=since.date())
+        
         # Get snapshots since last processing
-        new_snapshot_paths = get_snapshots_since(fs, BUCKET, last_processed, central_tz)
+        new_snapshot_paths = get_snapshots_since(listed_paths, last_processed, tz)
         print(f"New snapshots to process: {len(new_snapshot_paths)}")
+        _run["snapshots"] = len(new_snapshot_paths)
         
         if new_snapshot_paths:
-            # Process new snapshots and create/update daily aggregates
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Group snapshots by date
-                snapshots_by_date = {}
-                local_paths = []
-                
-                for i, gcs_path in enumerate(new_snapshot_paths):
-                    # Extract date from path
-                    path_parts = gcs_path.split('/')
-                    date_str = "-".join(path_parts[2:5])  # YYYY-MM-DD
-                    
-                    if date_str not in snapshots_by_date:
-                        snapshots_by_date[date_str] = []
-                    
-                    # Download snapshot
-                    local_path = os.path.join(temp_dir, f"snapshot_{i}.json.gz")
-                    with fs.open(gcs_path, 'rb') as src, open(local_path, 'wb') as dst:
-                        dst.write(src.read())
-                    
-                    snapshots_by_date[date_str].append(local_path)
-                    local_paths.append(local_path)
-                
-                # Process each date's snapshots
-                con = duckdb.connect()
-                con.execute("INSTALL httpfs; LOAD httpfs;")
-                
-                for date_str, date_paths in snapshots_by_date.items():
-                    print(f"Processing {len(date_paths)} snapshots for {date_str}")
-                    
-                    # Load snapshots for this date
-                    con.sql(f"DROP TABLE IF EXISTS snaps")
-                    con.sql(f"CREATE TABLE snaps AS SELECT * FROM read_json_auto({date_paths})")
-                    
-                    # Create daily aggregate
-                    daily_data = create_daily_aggregate(con, date_paths, date_str)
-                    save_daily_aggregate(bucket, daily_data)
+            # Merge new snapshots into the stored daily aggregates
+            with stage("daily_aggregates"), tempfile.TemporaryDirectory() as temp_dir:
+                update_daily_aggregates(fs, bucket, con, new_snapshot_paths, temp_dir, merge=True,
+                                        weighted=weighted, context_paths=listed_paths)
         
         # Load daily aggregates for DPI calculation
-        pct_full_df = load_daily_aggregates(fs, BUCKET, days=30)
+        with stage("load_daily_aggregates") as span:
+            window_dates = load_daily_aggregates(fs, bucket_name, con, days=CUBE_WINDOW_DAYS)
+            span["rows"] += len(window_dates)
         
-        if pct_full_df is None:
+        if not window_dates:
             print("No daily aggregates found, falling back to full processing")
             use_incremental = False
     
     if not use_incremental:
-        # Full processing (original logic)
+        # Full processing: rebuild every day in the window from scratch
         print("Using full processing mode")
-        since = now - dt.timedelta(days=30)
         print(f"Date range: {since.date()} to {now.date()}")
+        _run["mode"] = "full"
         
-        paths = fs.glob(f"{BUCKET}/snapshots/*/*/*/*.json.gz")
-        print(f"Total snapshot files found: {len(paths)}")
+        with stage("list") as span:
+            window_paths = list_snapshots(fs, bucket_name, since.date(), now.date())
+            span["rows"] += len(window_paths)
+        print(f"Snapshot files found in window: {len(window_paths)}")
+        _run["snapshots"] = len(window_paths)
+        with stage("compact"):
+            compact_finished_days(fs, bucket, con, window_paths, now.date(), since_date=since.date())
         
-        filtered_paths = [
-            p for p in paths
-            if dt.datetime.strptime("/".join(p.split('/')[2:5]), "%Y/%m/%d").date() >= since.date()
-        ]
-        
-        print(f"Filtered snapshot files (last 30 days): {len(filtered_paths)}")
-        
-        if not filtered_paths:
+        if not window_paths:
             print("ERROR: No snapshots found in date range")
             return ("no snapshots", 200)
 
-        # Download and process all snapshots
-        with tempfile.TemporaryDirectory() as temp_dir:
-            local_paths = []
-            print(f"Downloading {len(filtered_paths)} snapshot files...")
-            
-            for i, gcs_path in enumerate(filtered_paths):
-                local_path = os.path.join(temp_dir, f"snapshot_{i}.json.gz")
-                with fs.open(gcs_path, 'rb') as src, open(local_path, 'wb') as dst:
-                    dst.write(src.read())
-                local_paths.append(local_path)
-            
-            # Calculate pct_full from all snapshots
-            con = duckdb.connect()
-            con.execute("INSTALL httpfs; LOAD httpfs;")
-            con.sql(f"CREATE TABLE snaps AS SELECT * FROM read_json_auto({local_paths})")
-            
-            pct_full_result = con.sql("""
-                SELECT unnest.station_id,
-                       AVG((unnest.num_docks_available = 0)::INT) AS pct_full
-                FROM snaps
-                CROSS JOIN UNNEST(stations) AS unnest
-                GROUP BY 1
-            """)
-            
-            pct_full_df = pct_full_result.df()
+        # Download and aggregate all snapshots
+        with stage("daily_aggregates"), tempfile.TemporaryDirectory() as temp_dir:
+            update_daily_aggregates(fs, bucket, con, window_paths, temp_dir, merge=False, weighted=weighted)
+        
+        # Longer cubes also take any older stored days; the rebuilt ones are re-cached
+        # since their generation changed
+        with stage("load_daily_aggregates") as span:
+            window_dates = load_daily_aggregates(fs, bucket_name, con, days=CUBE_WINDOW_DAYS)
+            span["rows"] += len(window_dates)
     
-    # Continue with DPI calculation (same for both modes)
-    if len(pct_full_df) == 0:
-        print("ERROR: No pct_full data calculated")
-        return ("no pct_full data", 500)
+    result = publish_outputs(fs, bucket, con, window_dates, now, weighted=weighted)
+    if result[1] == 200:
+        # Update last processed timestamp
+        save_last_processed_timestamp(bucket, now)
     
-    print(f"Stations with pct_full calculated: {len(pct_full_df)}")
+    print(f"=== ROLLUP DEBUG END ===")
+    return result
+
+def publish_outputs(fs, bucket, con, window_dates, now, weighted=False):
+    """Turn daily aggregates into live_dpi, the DPI cubes and today's history partition.
+
+    Shared by the daily rollup and the per-tick streaming update. Dimensions and
+    daily aggregates come from the warm state DB when unchanged. Returns (body, status).
+    """
+    # Refresh the static dimensions only if their source objects changed (the window
+    # below maps station ids to legacy ids through `cap`)
+    print("Checking historical data files...")
     
-    # Download historical data files
-    with tempfile.TemporaryDirectory() as temp_dir:
-        hist_local = os.path.join(temp_dir, "station_flows.parquet")
-        cap_local = os.path.join(temp_dir, "station_capacity.csv")
-        
-        print("Downloading historical data files...")
-        
+    with stage("dimensions"):
         try:
-            with fs.open(f"{BUCKET}/aggregated/station_flows.parquet", 'rb') as src, open(hist_local, 'wb') as dst:
-                dst.write(src.read())
-            print("✓ Downloaded station_flows.parquet")
+            refresh_dimension(con, fs, "hist", station_flow_paths(fs, bucket.name), """
+                SELECT station_id, SUM(starts)::BIGINT AS starts, SUM(ends)::BIGINT AS ends
+                FROM read_parquet({paths})
+                GROUP BY station_id
+            """)
         except Exception as e:
-            print(f"ERROR downloading station_flows.parquet: {e}")
+            print(f"ERROR loading station flows: {e}")
             return (f"Error: station_flows.parquet not found - {e}", 500)
         
         try:
-            with fs.open(f"{BUCKET}/station_capacity.csv", 'rb') as src, open(cap_local, 'wb') as dst:
-                dst.write(src.read())
-            print("✓ Downloaded station_capacity.csv")
+            refresh_capacity(con, fs, bucket.name)
         except Exception as e:
-            print(f"ERROR downloading station_capacity.csv: {e}")
-            return (f"Error: station_capacity.csv not found - {e}", 500)
-        
-        # Load historical data into DuckDB
-        con = duckdb.connect()
-        con.sql(f"CREATE TABLE hist AS SELECT * FROM read_parquet('{hist_local}')")
-        con.sql(f"CREATE TABLE cap  AS SELECT * FROM read_csv_auto('{cap_local}')")
-        
-        # Load pct_full data into DuckDB
-        con.register('pct_full_df', pct_full_df)
-        con.sql("CREATE TABLE pct_full AS SELECT * FROM pct_full_df")
-        
-        # Debug: Check data counts
-        hist_count = con.sql("SELECT COUNT(*) FROM hist").fetchone()[0]
-        cap_count = con.sql("SELECT COUNT(*) FROM cap").fetchone()[0]
-        pct_full_count = con.sql("SELECT COUNT(*) FROM pct_full").fetchone()[0]
-        print(f"Historical flow records: {hist_count}")
-        print(f"Capacity records: {cap_count}")
-        print(f"Pct_full records: {pct_full_count}")
-        
-        # Calculate final DPI
-        res = con.sql("""
-            SELECT h.station_id,
+            print(f"ERROR loading station dimension: {e}")
+            return (f"Error: station dimension / station_capacity.csv not found - {e}", 500)
+    
+    # Every cube reads the same unnested daily counts
+    with stage("window") as span:
+        span["rows"] += load_window_counts(con, window_dates) if window_dates else 0
+        cube_counts = cube_pct_full(con, now.date(), weighted=weighted) if window_dates else {}
+        heatmap_count = hour_of_week_pct_full(con) if window_dates else 0
+    
+    # Continue with DPI calculation (same for both modes)
+    pct_full_count = cube_counts.get(LIVE_DPI_CUBE, 0)
+    if pct_full_count == 0:
+        print("ERROR: No pct_full data calculated")
+        return ("no pct_full data", 500)
+    
+    print(f"Stations with pct_full calculated per cube: {cube_counts}")
+    print(f"Stations with an hour-of-week heatmap: {heatmap_count}")
+    
+    # Debug: Check data counts
+    hist_count = con.sql("SELECT COUNT(*) FROM hist").fetchone()[0]
+    cap_count = con.sql("SELECT COUNT(*) FROM cap").fetchone()[0]
+    print(f"Historical flow records: {hist_count}")
+    print(f"Capacity records: {cap_count}")
+    print(f"Pct_full records: {pct_full_count}")
+    
+    # Calculate final DPI for every cube in one join against the dimensions
+    with stage("dpi") as span:
+        # One name and capacity per legacy id: the station's current version
+        con.sql("""
+            CREATE OR REPLACE TEMP TABLE legacy_cap AS
+            SELECT legacy_id::VARCHAR AS legacy_id, name, capacity
+            FROM cap
+            WHERE legacy_id IS NOT NULL
+            QUALIFY row_number() OVER (PARTITION BY legacy_id ORDER BY effective_from DESC NULLS LAST, station_id) = 1
+        """)
+        con.sql("""
+            CREATE OR REPLACE TEMP TABLE dpi AS
+            SELECT pf.cube,
+                   h.station_id,
                    cap.name                                             AS station_name,
-                   ROUND((h.ends - h.starts)::FLOAT / cap.capacity, 3)   AS overflow_per_dock,
+                   ROUND((h.ends - h.starts)::DOUBLE / cap.capacity, 3)   AS overflow_per_dock,
                    ROUND(pf.pct_full, 3)                                AS pct_full,
-                   ROUND((h.ends - h.starts)::FLOAT / cap.capacity * pf.pct_full, 3) AS dpi
+                   ROUND((h.ends - h.starts)::DOUBLE / cap.capacity * pf.pct_full, 3) AS dpi
             FROM hist h 
-            JOIN cap ON h.station_id = cap.legacy_id 
-            JOIN pct_full pf ON cap.station_id = pf.station_id
-            ORDER BY dpi DESC
-        """).df()
-        
-        print(f"Final DPI results: {len(res)} rows")
-        if len(res) > 0:
-            print(f"Top 3 DPI stations: {res.head(3).to_dict('records')}")
-
-    # Save results
-    payload = res.to_dict(orient="records")
-    buf = gzip.compress(json.dumps(payload).encode())
-    bucket.blob("aggregated/live_dpi.json.gz").upload_from_string(buf, content_type="application/json")
+            JOIN legacy_cap cap ON h.station_id::VARCHAR = cap.legacy_id
+            JOIN pct_full pf ON cap.legacy_id = pf.station_id
+        """)
+        dpi_count = con.execute("SELECT COUNT(*) FROM dpi WHERE cube = ?", [LIVE_DPI_CUBE]).fetchone()[0]
+        span["rows"] += con.sql("SELECT COUNT(*) FROM dpi").fetchone()[0]
     
-    # Update last processed timestamp
-    save_last_processed_timestamp(bucket, now)
+    print(f"Final DPI results: {dpi_count} rows")
+    if dpi_count > 0:
+        top = con.execute("SELECT * EXCLUDE (cube) FROM dpi WHERE cube = ? ORDER BY dpi DESC LIMIT 3", [LIVE_DPI_CUBE])
+        print(f"Top 3 DPI stations: {[dict(zip([d[0] for d in top.description], row)) for row in top.fetchall()]}")
+
+    # Save results: DuckDB writes each gzipped JSON array itself, in DPI order
+    with stage("upload"), tempfile.TemporaryDirectory() as temp_dir:
+        for cube in DPI_CUBES:
+            local_path = os.path.join(temp_dir, f"{cube}.json.gz")
+            con.sql(f"""
+                COPY (SELECT * EXCLUDE (cube) FROM dpi WHERE cube = '{cube}' ORDER BY dpi DESC)
+                TO '{local_path}' (FORMAT JSON, ARRAY true, COMPRESSION gzip)
+            """)
+            bucket.blob(f"{CUBES_PREFIX}/{cube}.json.gz").upload_from_filename(local_path, content_type="application/json")
+            if cube == LIVE_DPI_CUBE:
+                bucket.blob("aggregated/live_dpi.json.gz").upload_from_filename(local_path, content_type="application/json")
+        
+        # Heatmap rows use the same station ids and names as the DPI cubes
+        local_path = os.path.join(temp_dir, f"{HEATMAP_CUBE}.json.gz")
+        con.sql(f"""
+            COPY (
+                SELECT cap.legacy_id AS station_id, cap.name AS station_name, hm.pct_full_by_hour
+                FROM heatmap hm
+                JOIN legacy_cap cap ON cap.legacy_id = hm.station_id
+                ORDER BY 1
+            ) TO '{local_path}' (FORMAT JSON, ARRAY true, COMPRESSION gzip)
+        """)
+        bucket.blob(f"{CUBES_PREFIX}/{HEATMAP_CUBE}.json.gz").upload_from_filename(local_path, content_type="application/json")
+        
+        # Keep this run's ranking in the history series (a rerun on the same day replaces it)
+        save_dpi_history(con, bucket, now.date().strftime("%Y-%m-%d"), temp_dir)
     
-    print(f"=== ROLLUP DEBUG END ===")
-    return (f"{len(res)} rows → live_dpi.json.gz", 200)
+    return (f"{dpi_count} rows → live_dpi.json.gz (+{len(DPI_CUBES) + 1} cubes)", 200)
@@ -1,29 +1,235 @@
-import json, gzip, io, datetime as dt, requests, functions_framework, os
-from google.cloud import storage
+import asyncio, json, gzip, io, datetime as dt, requests, functions_framework, os
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.cloud import storage, pubsub_v1
 import pytz
 
 BUCKET = os.getenv('BUCKET_NAME', 'your-bucket-name')  # Replace with your bucket name
-FEED   = "https://gbfs.divvybikes.com/gbfs/en/station_status.json"
+# GBFS_SYSTEMS: JSON list from deploy.sh / config.env; "divvy" keeps the bucket root, other ids use systems/{id}/
+DEFAULT_SYSTEM = "divvy"
+SYSTEMS = json.loads(os.environ['GBFS_SYSTEMS'])
+SCRAPE_CONCURRENCY = int(os.getenv('SCRAPE_CONCURRENCY', '8'))  # Feeds fetched at once
+STATE_BLOB = "aggregated/scraper_state.json"  # Last feed version seen + no-change marker (per system)
+# Every station's current record as of the newest snapshot, at a fixed name so readers never list
+LIVE_STATUS_BLOB = "aggregated/live_status.json.gz"
+# Pub/Sub topic told of each live_status write (drives the streaming rollup); unset = no messages
+TICK_TOPIC = os.getenv('TICK_TOPIC')
+KEYFRAME_HOURS = int(os.getenv('KEYFRAME_HOURS', '6'))  # Full keyframe at least this often (and daily)
+# Only the station fields the rollup reads are stored
+KEPT_FIELDS = ["station_id", "num_docks_available", "num_bikes_available", "is_returning", "last_reported"]
 client = storage.Client()
 bucket = client.bucket(BUCKET)
 
+# Pooled, keep-alive session reused across warm invocations (one connection pool per feed host)
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_maxsize=SCRAPE_CONCURRENCY,
+                                      max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=[502, 503, 504])))
+
+# Warm-instance copy of each system's feed state so we only read its STATE_BLOB on cold start
+_feed_state = {}
+
+# Created on first use, only when TICK_TOPIC is set
+_publisher = None
+
+# Per system: station records as of the last snapshot this instance wrote; deltas are taken
+# against them. A cold instance has none, so each system's first snapshot is a keyframe.
+_previous = {}
+
+def system_root(system_id):
+    """Blob prefix of one system's snapshots and state ('' for DEFAULT_SYSTEM)."""
+    return "" if system_id == DEFAULT_SYSTEM else f"systems/{system_id}/"
+
+def load_feed_state(system_id):
+    """Return the last feed version we saw for a system (last_updated, ttl, HTTP validators)."""
+    if system_id not in _feed_state:
+        blob = bucket.blob(system_root(system_id) + STATE_BLOB)
+        _feed_state[system_id] = json.loads(blob.download_as_text()) if blob.exists() else {}
+    return _feed_state[system_id]
+
+def save_feed_state(system_id, state):
+    """Persist a system's feed state (and keep it for the next warm invocation)."""
+    _feed_state[system_id] = state
+    bucket.blob(system_root(system_id) + STATE_BLOB).upload_from_string(json.dumps(state), content_type="application/json")
+
+def publish_tick(system_id, generation):
+    """Tell the streaming rollup which live_status generation holds a new tick.
+
+    A failed publish only delays the tick until the daily rollup recounts the
+    day, so it's logged rather than failing the scrape.
+    """
+    global _publisher
+    if not TICK_TOPIC:
+        return
+    try:
+        if _publisher is None:
+            _publisher = pubsub_v1.PublisherClient()
+        _publisher.publish(TICK_TOPIC, json.dumps({"system": system_id, "generation": generation}).encode()).result(timeout=10)
+    except Exception as e:
+        print(f"Could not publish tick for {system_id}: {e}")
+
+def load_live_records(system_id):
+    """Station records from the system's live_status (the state of its last stored snapshot), or None."""
+    blob = bucket.get_blob(system_root(system_id) + LIVE_STATUS_BLOB)
+    if blob is None:
+        return None
+    live = json.loads(gzip.decompress(blob.download_as_bytes()))
+    return {str(r["station_id"]): r for r in live["stations"]}
+
+def gzip_json(doc):
+    """Gzipped JSON bytes of a document."""
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="w") as gz:
+        gz.write(json.dumps(doc).encode())
+    return buf.getvalue()
+
+def encode_snapshot(previous_state, stations, ts_local, ts_utc):
+    """Build the snapshot document: a full keyframe or only the stations that changed.
+
+    A keyframe is written on cold start, on the first snapshot of each local day
+    (so every day's folder can be rebuilt on its own) and at least every
+    KEYFRAME_HOURS. Otherwise only stations whose record (including last_reported)
+    differs from the previous snapshot are kept. `previous_state` is the system's
+    entry in _previous.
+    """
+    records = {str(s["station_id"]): {f: s.get(f) for f in KEPT_FIELDS} for s in stations}
+    previous, keyframe_at = previous_state["stations"], previous_state["keyframe_at"]
+    keyframe = (
+        previous is None
+        or keyframe_at is None
+        or keyframe_at.date() != ts_local.date()
+        or ts_local - keyframe_at >= dt.timedelta(hours=KEYFRAME_HOURS)
+    )
+    if keyframe:
+        changed = list(records.values())
+    else:
+        changed = [r for sid, r in records.items() if previous.get(sid) != r]
+    doc = {"timestamp": ts_utc.isoformat(), "keyframe": keyframe, "stations": changed}
+    return doc, records
+
+def store_snapshot(system_id, previous_state, doc, records, ts_local):
+    """Write a snapshot (and, when the full state is known, live_status) and advance the delta base."""
+    # Use the system's local time for the folder structure
+    blob = bucket.blob(f"{system_root(system_id)}snapshots/{ts_local:%Y/%m/%d}/{ts_local:%H%M%S}.json.gz")
+    blob.upload_from_file(io.BytesIO(gzip_json(doc)), content_type="application/json")
+
+    if records is not None:
+        # Full current state for the read-API's live endpoint (deltas alone can't be read on their own)
+        live_blob = bucket.blob(system_root(system_id) + LIVE_STATUS_BLOB)
+        live_blob.upload_from_string(
+            gzip_json({"timestamp": doc["timestamp"], "snapshot": blob.name, "stations": list(records.values())}),
+            content_type="application/json")
+        publish_tick(system_id, live_blob.generation)
+
+        # Only advance the delta base once the snapshot is safely stored
+        previous_state["stations"] = records
+    if doc["keyframe"]:
+        previous_state["keyframe_at"] = ts_local
+    return blob
+
+def record_unchanged(system_id, state, ts_utc, ts_local, reason):
+    """Store an empty delta for a tick whose feed didn't change, so it still counts as a sample.
+
+    The rollup carries each station's last record forward, so an empty delta is
+    enough for the tick to be counted. When a keyframe is due (new local day or
+    KEYFRAME_HOURS elapsed), the previous state is written as the keyframe instead.
+    A cold instance reads that state back from live_status and writes it as a
+    keyframe, so the tick still updates live_status (and reaches the streaming rollup).
+    """
+    previous_state = _previous.setdefault(system_id, {"stations": None, "keyframe_at": None})
+    if previous_state["stations"] is None:
+        # keyframe_at is still None on a cold instance, so this is written as a keyframe
+        previous_state["stations"] = load_live_records(system_id)
+    if previous_state["stations"] is not None:
+        doc, records = encode_snapshot(previous_state, list(previous_state["stations"].values()), ts_local, ts_utc)
+    else:
+        # No live_status yet: the delta base is unknown, but an empty delta is still correct
+        doc, records = {"timestamp": ts_utc.isoformat(), "keyframe": False, "stations": []}, None
+    blob = store_snapshot(system_id, previous_state, doc, records, ts_local)
+
+    state = {**state, "last_checked": ts_utc.isoformat(), "unchanged_ticks": state.get("unchanged_ticks", 0) + 1}
+    save_feed_state(system_id, state)
+    kind = "keyframe" if doc["keyframe"] else "empty delta"
+    return f"unchanged ({reason}) since {state.get('last_snapshot')}, saved {blob.name} ({kind})"
+
+def scrape_system(system, ts_utc):
+    """Fetch one system's station_status and store a snapshot if it changed; returns a summary."""
+    system_id = system["id"]
+    # Local time of the system for the folder structure (the rollup reads days in it)
+    ts_local = ts_utc.astimezone(pytz.timezone(system.get("timezone", "America/Chicago")))
+
+    state = load_feed_state(system_id)
+
+    # GBFS promises the data won't change until last_updated + ttl
+    last_updated = state.get("last_updated")
+    if isinstance(last_updated, (int, float)) and ts_utc.timestamp() < last_updated + state.get("ttl", 0):
+        return record_unchanged(system_id, state, ts_utc, ts_local, "within ttl")
+
+    headers = {}
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+
+    resp = session.get(system["station_status"], headers=headers, timeout=10)
+    if resp.status_code == 304:
+        return record_unchanged(system_id, state, ts_utc, ts_local, "not modified")
+    resp.raise_for_status()
+    feed = resp.json()
+
+    if feed.get("last_updated") is not None and feed.get("last_updated") == last_updated:
+        return record_unchanged(system_id, state, ts_utc, ts_local, "same last_updated")
+
+    # Store UTC timestamp in the data for consistency across timezones
+    previous_state = _previous.setdefault(system_id, {"stations": None, "keyframe_at": None})
+    doc, records = encode_snapshot(previous_state, feed["data"]["stations"], ts_local, ts_utc)
+
+    blob = store_snapshot(system_id, previous_state, doc, records, ts_local)
+
+    save_feed_state(system_id, {
+        "last_updated": feed.get("last_updated"),
+        "ttl": feed.get("ttl", 0),
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "last_snapshot": blob.name,
+        "last_checked": ts_utc.isoformat(),
+        "unchanged_ticks": 0,
+    })
+
+    kind = "keyframe" if doc["keyframe"] else f"delta, {len(doc['stations'])} changed"
+    return f"saved {blob.name} ({kind})"
+
+async def scrape_systems(systems, ts_utc):
+    """Scrape every system concurrently, at most SCRAPE_CONCURRENCY at a time.
+
+    Each system runs in a worker thread on the shared pooled session; a failing
+    feed is reported as its exception and doesn't affect the others.
+    """
+    limit = asyncio.Semaphore(SCRAPE_CONCURRENCY)
+
+    async def scrape_one(system):
+        async with limit:
+            return await asyncio.to_thread(scrape_system, system, ts_utc)
+
+    return await asyncio.gather(*(scrape_one(s) for s in systems), return_exceptions=True)
+
 @functions_framework.http
 def grab(request):
-    # Use Central Time for folder structure to match local timezone
-    central_tz = pytz.timezone('America/Chicago')
-    ts_central = dt.datetime.now(central_tz)
-    # Keep UTC timestamp for the data itself for consistency
-    ts_utc = dt.datetime.now(dt.timezone.utc)
-    
-    data = requests.get(FEED, timeout=10).json()["data"]["stations"]
+    """Scrape every configured system (or only ?system=<id>) into its own snapshot folders."""
+    systems = SYSTEMS
+    if request.args.get("system"):
+        systems = [s for s in SYSTEMS if s["id"] == request.args["system"]]
+        if not systems:
+            return f"unknown system {request.args['system']!r}", 400
 
-    # Use Central Time for folder structure
-    blob = bucket.blob(f"snapshots/{ts_central:%Y/%m/%d}/{ts_central:%H%M%S}.json.gz")
-    buf  = io.BytesIO()
-    with gzip.GzipFile(fileobj=buf, mode="w") as gz:
-        # Store UTC timestamp in the data for consistency across timezones
-        gz.write(json.dumps({"timestamp": ts_utc.isoformat(), "stations": data}).encode())
-    buf.seek(0)
-    blob.upload_from_file(buf, content_type="application/json")
+    ts_utc = dt.datetime.now(dt.timezone.utc)
+    results = asyncio.run(scrape_systems(systems, ts_utc))
 
-    return f"saved {blob.name}", 200
+    lines, failed = [], 0
+    for system, result in zip(systems, results):
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"ERROR scraping {system['id']}: {result}")
+            result = f"error: {result}"
+        lines.append(f"{system['id']}: {result}")
+    # Only a total outage is an error; one bad feed shouldn't fail the tick for the others
+    return "\n".join(lines), 502 if failed == len(systems) else 200
@@ -0,0 +1,159 @@
+import csv, io, json, os, tempfile, datetime as dt, duckdb, requests, functions_framework
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.cloud import storage
+
+BUCKET = os.getenv('BUCKET_NAME', 'your-bucket-name')  # Replace with your bucket name
+# GBFS_SYSTEMS: JSON list from deploy.sh / config.env; "divvy" keeps the bucket root, other ids use systems/{id}/
+DEFAULT_SYSTEM = "divvy"
+SYSTEMS = json.loads(os.environ['GBFS_SYSTEMS'])
+DIM_BLOB = "aggregated/station_dim.parquet"  # Versioned station dimension (one row per station version)
+CSV_BLOB = "station_capacity.csv"  # Current stations only, for the read-API and older readers
+TRACKED_FIELDS = ["legacy_id", "name", "lat", "lon", "capacity"]  # A change in any of these opens a new version
+client = storage.Client()
+bucket = client.bucket(BUCKET)
+
+session = requests.Session()
+session.mount("https://", HTTPAdapter(max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=[502, 503, 504])))
+
+# One row per version of a station; the current version has effective_to NULL
+DIM_DDL = """
+CREATE TABLE station_dim (
+    station_id     VARCHAR,
+    legacy_id      VARCHAR,
+    name           VARCHAR,
+    lat            DOUBLE,
+    lon            DOUBLE,
+    capacity       INTEGER,
+    effective_from TIMESTAMPTZ,
+    effective_to   TIMESTAMPTZ
+)
+"""
+
+def system_root(system_id):
+    """Blob prefix of one system's station files ('' for DEFAULT_SYSTEM)."""
+    return "" if system_id == DEFAULT_SYSTEM else f"systems/{system_id}/"
+
+def fetch_stations(feed_url):
+    """Current stations from a station_information.json as typed tuples."""
+    resp = session.get(feed_url, timeout=10)
+    resp.raise_for_status()
+    return [
+        (
+            str(s["station_id"]),
+            str(s["short_name"]) if s.get("short_name") else None,  # Legacy id used in the trip CSVs
+            s.get("name"),
+            float(s["lat"]),
+            float(s["lon"]),
+            int(s["capacity"]) if s.get("capacity") is not None else None,
+        )
+        for s in resp.json()["data"]["stations"]
+    ]
+
+def diff_stations(con):
+    """Compare the `feed` table with the current dimension rows; returns {change: [station_id]}."""
+    changed_expr = " OR ".join(f"f.{c} IS DISTINCT FROM d.{c}" for c in TRACKED_FIELDS)
+    rows = con.sql(f"""
+        SELECT COALESCE(f.station_id, d.station_id) AS station_id,
+               CASE WHEN d.station_id IS NULL THEN 'added'
+                    WHEN f.station_id IS NULL THEN 'removed'
+                    ELSE 'changed' END AS change
+        FROM feed f
+        FULL OUTER JOIN (SELECT * FROM station_dim WHERE effective_to IS NULL) d
+          ON f.station_id = d.station_id
+        WHERE d.station_id IS NULL OR f.station_id IS NULL OR {changed_expr}
+    """).fetchall()
+    changes = {"added": [], "changed": [], "removed": []}
+    for station_id, change in rows:
+        changes[change].append(station_id)
+    return changes
+
+def write_capacity_csv(con, root=""):
+    """Rewrite station_capacity.csv from the current dimension rows."""
+    rows = con.sql("""
+        SELECT station_id, legacy_id, name, lat, lon, capacity
+        FROM station_dim WHERE effective_to IS NULL ORDER BY station_id
+    """).fetchall()
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["station_id", "legacy_id", "name", "lat", "lon", "capacity"])
+    writer.writerows([["" if v is None else v for v in row] for row in rows])
+    bucket.blob(root + CSV_BLOB).upload_from_string(out.getvalue(), content_type="text/csv")
+
+@functions_framework.http
+def sync_stations(request):
+    """Sync every configured system (or only ?system=<id>); one failing feed doesn't stop the rest."""
+    systems = SYSTEMS
+    if request.args.get("system"):
+        systems = [s for s in SYSTEMS if s["id"] == request.args["system"]]
+        if not systems:
+            return (f"unknown system {request.args['system']!r}", 400)
+
+    results = []
+    for system in systems:
+        try:
+            body, status = sync_system(system)
+        except Exception as e:
+            print(f"ERROR syncing stations for {system['id']}: {e}")
+            body, status = f"error: {e}", 500
+        results.append((system["id"], body, status))
+
+    if len(results) == 1:
+        return results[0][1:]
+    return ("\n".join(f"{system_id}: {body}" for system_id, body, _ in results),
+            max(status for _, _, status in results))
+
+def sync_system(system):
+    """Diff one system's station_information.json against its stored dimension and version what changed."""
+    root = system_root(system["id"])
+    now = dt.datetime.now(dt.timezone.utc)
+    stations = fetch_stations(system["station_information"])
+    if not stations:
+        # An empty feed is an outage, not every station closing at once
+        return ("station_information.json returned no stations", 502)
+
+    con = duckdb.connect()
+    con.execute(DIM_DDL)
+    con.execute("CREATE TEMP TABLE feed AS SELECT * EXCLUDE (effective_from, effective_to) FROM station_dim LIMIT 0")
+    con.executemany("INSERT INTO feed VALUES (?, ?, ?, ?, ?, ?)", stations)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        local_path = os.path.join(temp_dir, "station_dim.parquet")
+        stored = bucket.get_blob(root + DIM_BLOB)
+        if stored is not None:
+            stored.download_to_filename(local_path)
+            con.execute(f"INSERT INTO station_dim SELECT * FROM read_parquet('{local_path}')")
+
+        changes = diff_stations(con)
+        if not any(changes.values()):
+            # Nothing to write: the dimension's generation stays the same and readers keep their cache
+            print(f"✓ {len(stations)} stations unchanged")
+            return (f"unchanged (generation {stored.generation})", 200)
+
+        # Close the current version of changed/removed stations and open one for added/changed
+        closed = changes["changed"] + changes["removed"]
+        opened = changes["added"] + changes["changed"]
+        if closed:
+            con.execute(f"""
+                UPDATE station_dim SET effective_to = ?
+                WHERE effective_to IS NULL AND station_id IN ({', '.join('?' * len(closed))})
+            """, [now, *closed])
+        if opened:
+            con.execute(f"""
+                INSERT INTO station_dim
+                SELECT *, ?::TIMESTAMPTZ, NULL FROM feed WHERE station_id IN ({', '.join('?' * len(opened))})
+            """, [now, *opened])
+
+        con.sql(f"""
+            COPY (SELECT * FROM station_dim ORDER BY station_id, effective_from)
+            TO '{local_path}' (FORMAT PARQUET, COMPRESSION ZSTD)
+        """)
+        blob = bucket.blob(root + DIM_BLOB)
+        # Refuse to overwrite a version written concurrently by another sync
+        blob.upload_from_filename(local_path, content_type="application/octet-stream",
+                                  if_generation_match=stored.generation if stored is not None else 0)
+
+    write_capacity_csv(con, root)
+    summary = ", ".join(f"{len(ids)} {change}" for change, ids in changes.items())
+    print(f"✓ Station dimension updated: {summary}")
+    return (f"{summary} → generation {blob.generation}", 200)
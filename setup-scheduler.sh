@@ -23,7 +23,7 @@ fi
 # Check if functions exist before setting up scheduler
 echo "🔍 Checking if functions are deployed..."
 
-for func in "divvy-scraper" "divvy-rollup"; do
+for func in "divvy-scraper" "divvy-rollup" "divvy-stations"; do
     if ! gcloud functions describe $func --gen2 --region=$REGION --quiet > /dev/null 2>&1; then
         echo "❌ Function $func not found in region $REGION"
         echo "   Please deploy functions first: ./deploy.sh"
@@ -36,9 +36,19 @@ done
 echo ""
 echo "🕐 Setting up Cloud Scheduler jobs..."
 
+# One rollup job per GBFS system so each gets a whole invocation (and timeout) of its own;
+# divvy keeps the original job name
+SYSTEM_IDS=$(python3 -c '
+import json, os
+print(" ".join(s["id"] for s in json.loads(os.environ.get("GBFS_SYSTEMS") or "[{\"id\": \"divvy\"}]")))')
+rollup_job() { [ "$1" = "divvy" ] && echo "divvy-rollup-daily" || echo "divvy-rollup-daily-$1"; }
+
 # Delete existing jobs if they exist (ignore errors)
 gcloud scheduler jobs delete divvy-scraper-15 --location=$REGION --quiet 2>/dev/null || true
-gcloud scheduler jobs delete divvy-rollup-daily --location=$REGION --quiet 2>/dev/null || true
+for id in $SYSTEM_IDS; do
+    gcloud scheduler jobs delete $(rollup_job $id) --location=$REGION --quiet 2>/dev/null || true
+done
+gcloud scheduler jobs delete divvy-stations-daily --location=$REGION --quiet 2>/dev/null || true
 
 # Every 15 minutes scraper
 echo "Creating scraper job (every 15 minutes)..."
@@ -49,11 +59,23 @@ gcloud scheduler jobs create http divvy-scraper-15 \
   --time-zone "America/Chicago" \
   --location $REGION
 
-# Daily roll-up at 02:15 AM Central Time
-echo "Creating rollup job (daily at 2:15 AM)..."
-gcloud scheduler jobs create http divvy-rollup-daily \
-  --schedule "15 2 * * *" \
-  --uri $(gcloud functions describe divvy-rollup --gen2 --region $REGION --format 'value(serviceConfig.uri)') \
+# Daily roll-up at 02:15 AM Central Time, one job per system (?system=<id>)
+ROLLUP_URI=$(gcloud functions describe divvy-rollup --gen2 --region $REGION --format 'value(serviceConfig.uri)')
+for id in $SYSTEM_IDS; do
+    echo "Creating rollup job for $id (daily at 2:15 AM)..."
+    gcloud scheduler jobs create http $(rollup_job $id) \
+      --schedule "15 2 * * *" \
+      --uri "$ROLLUP_URI?system=$id" \
+      --http-method GET \
+      --time-zone "America/Chicago" \
+      --location $REGION
+done
+
+# Daily station-information sync at 01:45 AM, ahead of the roll-up
+echo "Creating stations sync job (daily at 1:45 AM)..."
+gcloud scheduler jobs create http divvy-stations-daily \
+  --schedule "45 1 * * *" \
+  --uri $(gcloud functions describe divvy-stations --gen2 --region $REGION --format 'value(serviceConfig.uri)') \
   --http-method GET \
   --time-zone "America/Chicago" \
   --location $REGION
@@ -63,7 +85,8 @@ echo "✅ Cloud Scheduler jobs created successfully!"
 echo ""
 echo "📋 Scheduler Summary:"
 echo "  • Scraper runs every 15 minutes"
-echo "  • Rollup runs daily at 2:15 AM Central Time"
+echo "  • Rollup runs daily at 2:15 AM Central Time (one job per system: $SYSTEM_IDS)"
+echo "  • Station sync runs daily at 1:45 AM Central Time"
 echo ""
 echo "🔧 Management commands:"
 echo "  View jobs:      gcloud scheduler jobs list --location=$REGION"